@@ -0,0 +1,124 @@
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+import utils
+from config import ANIDB_MALID_CACHE_PATH
+from metrics import InstrumentedSession
+from rateLimit import HostRateLimiter
+from utils import log
+
+ANIDB_URL = config.ANIDB_URL
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/77.0 Safari/537.36'
+# Anime without a MyAnimeList link are checked again after 30 days in case one has been added
+NO_MALID_RETRY_SECONDS = 30 * 24 * 60 * 60
+MALID_PATTERN = re.compile(r'href=[\'"]https?://(?:www\.)?myanimelist\.net/anime/(\d+)')
+
+
+class AnidbResolver:
+    def __init__(self, base_url: str = ANIDB_URL, workers: int = None, requests_per_second: float = None):
+        """ Resolves anidb ids to myanimelist ids from the links on the anidb anime pages.
+
+        Pages are fetched over http by a bounded thread pool that shares a per-host rate limit.
+        Both found ids and pages without a MyAnimeList link are cached on disk.
+
+        :param base_url: The anidb url, this can be pointed at a local server for testing.
+        :param workers: The number of pages to fetch at the same time.
+        :param requests_per_second: The maximum number of requests made to each host per second.
+        """
+        self.base_url = base_url.rstrip('/')
+        self.workers = workers or config.ANIDB_WORKERS
+        self.rate_limiter = HostRateLimiter(requests_per_second or config.ANIDB_REQUESTS_PER_SECOND)
+        self._cache = None
+        self._lock = threading.Lock()
+
+        self.session = InstrumentedSession('anidb')
+        self.session.headers.update({'User-Agent': USER_AGENT})
+        self.session.mount(self.base_url, HTTPAdapter(pool_connections = 1, pool_maxsize = self.workers))
+
+    def _get_cache(self) -> dict:
+        with self._lock:
+            if self._cache is None:
+                self._cache = utils.load_json(ANIDB_MALID_CACHE_PATH) or {}
+            return self._cache
+
+    def get_cached(self, anidb_id: str) -> Optional[dict]:
+        """ Gets the cached result for an anidb id if it is still valid.
+
+        :return: Dictionary with the mal_id, which is None when the page has no link, or None if it isn't cached.
+        """
+        result = self._get_cache().get(anidb_id)
+        if result is None:
+            return None
+
+        if result.get('mal_id') is None and time.time() - result.get('checked_at', 0) >= NO_MALID_RETRY_SECONDS:
+            return None
+
+        return result
+
+    def fetch_malid(self, anidb_id: str) -> Optional[str]:
+        """ Fetches the anidb page for the anime and finds the myanimelist id in it.
+
+        :param anidb_id: The anidb id for the anime.
+        :return: The myanimelist id or None if the page doesn't link to MyAnimeList.
+        """
+        url = f'{self.base_url}/anime/{anidb_id}'
+        self.rate_limiter.acquire(url)
+        r = self.session.get(url, timeout = 30)
+        r.raise_for_status()
+
+        match = MALID_PATTERN.search(r.text)
+        return match.group(1) if match else None
+
+    def _resolve_one(self, anidb_id: str) -> Optional[dict]:
+        try:
+            mal_id = self.fetch_malid(anidb_id)
+        except requests.RequestException as e:
+            # Failed requests aren't cached so they are tried again next sync
+            log(f"Failed to get anidb page for {anidb_id}: {e}")
+            return None
+
+        result = {'mal_id': mal_id, 'checked_at': time.time()}
+        with self._lock:
+            self._cache[anidb_id] = result
+
+        return result
+
+    def resolve(self, anidb_ids: list) -> dict:
+        """ Resolves many anidb ids at once, only fetching the ones that aren't cached.
+
+        :param anidb_ids: List of anidb ids.
+        :return: Dictionary of the anidb ids to their myanimelist id, or None if the anidb page has no link.
+                 Ids whose page couldn't be fetched are left out.
+        """
+        results = {}
+        to_fetch = []
+        for anidb_id in dict.fromkeys(anidb_ids):
+            cached = self.get_cached(anidb_id)
+            if cached is None:
+                to_fetch.append(anidb_id)
+            else:
+                results[anidb_id] = cached.get('mal_id')
+
+        if len(to_fetch) == 0:
+            return results
+
+        log(f"Getting mal ids for {len(to_fetch)} anidb entries")
+        with ThreadPoolExecutor(max_workers = self.workers) as executor:
+            for anidb_id, result in zip(to_fetch, executor.map(self._resolve_one, to_fetch)):
+                if result is not None:
+                    results[anidb_id] = result.get('mal_id')
+
+        with self._lock:
+            utils.save_json(self._cache, ANIDB_MALID_CACHE_PATH)
+
+        return results
+
+
+anidb_resolver = AnidbResolver()
@@ -0,0 +1,130 @@
+""" Checks the http MyAnimeList updater against the local MyAnimeList stand-in without starting chrome.
+
+Run from the repository root with:
+
+    python benchmarks/checkHttpUpdater.py
+
+It exits with a non-zero code if any check fails.
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.dirname(BENCHMARK_PATH)
+
+failures = []
+
+
+def check(condition: bool, description: str) -> None:
+    print(f"{'ok  ' if condition else 'FAIL'} {description}")
+    if not condition:
+        failures.append(description)
+
+
+def run_checks(mal) -> None:
+    """ Runs the checks, the repository modules can only be imported once the config file exists. """
+    sys.path.insert(0, REPO_PATH)
+    from flask import Flask
+    from flask_socketio import SocketIO
+    import config
+    # Updates are sent to the web page as they are made so a socketio server is needed, it has no clients
+    config.socketio = SocketIO(Flask(__name__))
+
+    import syncHandler
+    import malSession
+    import mapping
+    from browserPool import browser_pool
+    from malList import MalList
+    from malUpdater import MalHttpUpdater
+    from profiles import profiles
+
+    updater = MalHttpUpdater(mal.url, 'check', 'check')
+    check(updater.login_myanimelist(), "logs in")
+    check(mal.requests.get('POST login') == 1, "logs in with the login form when there are no saved cookies")
+    check(updater.csrf_token == mal.CSRF_TOKEN, "reads the csrf token from the login page")
+
+    mal.reset()
+    updater = MalHttpUpdater(mal.url, 'check', 'check')
+    check(updater.login_myanimelist(), "logs in again")
+    check(mal.requests.get('POST login') is None and mal.requests.get('GET panel') == 1,
+          "reuses the saved cookies instead of the login form")
+    check(os.stat(malSession.get_cookie_path('check')).st_mode & 0o777 == 0o600,
+          "saves the cookies so only their owner can read them")
+
+    not_on_list = next(x for x in sorted(mal.dataset.episodes) if x not in mal.mal_list)
+    status = updater.update_series({'title': 'Not on list', 'season': 1, 'tvdb_id': '1', 'mal_id': not_on_list,
+                                    'watched_episodes': 3, 'on_list': False})
+    entry = mal.mal_list.get(not_on_list) or {}
+    check(status == '1' and entry.get('num_watched_episodes') == 3 and entry.get('status') == 1,
+          "adds an anime that isn't on the list as watching")
+
+    on_list = next(iter(sorted(mal.mal_list)))
+    total = mal.dataset.episodes.get(on_list)
+    status = updater.update_series({'title': 'On list', 'season': 1, 'tvdb_id': '2', 'mal_id': on_list,
+                                    'watched_episodes': total + 5, 'total_episodes': total, 'on_list': True})
+    entry = mal.mal_list.get(on_list)
+    check(status == '2' and entry.get('num_watched_episodes') == total and entry.get('status') == 2,
+          "completes an anime on the list without going over its episode count")
+
+    status = updater.update_series({'title': 'Out of date list', 'season': 1, 'tvdb_id': '3',
+                                    'mal_id': next(x for x in sorted(mal.dataset.episodes) if x not in mal.mal_list),
+                                    'watched_episodes': 1, 'total_episodes': total, 'on_list': True})
+    check(status == '1', "adds an anime the saved list wrongly shows as on the list")
+
+    status = updater.update_series({'title': 'Missing', 'season': 1, 'tvdb_id': '4', 'mal_id': '1',
+                                    'watched_episodes': 1, 'on_list': False})
+    check(status is None and mapping.has_mapping_error('4', '1'),
+          "records a mapping error for an anime whose page doesn't exist")
+
+    updater.csrf_token = 'wrong'
+    status = updater.update_series({'title': 'Rejected', 'season': 1, 'tvdb_id': '5', 'mal_id': on_list,
+                                    'watched_episodes': 1, 'total_episodes': total, 'on_list': True})
+    check(status is None, "reports an update MyAnimeList rejects as failed")
+    updater.quit()
+
+    to_update = [{'title': f'Pooled {x}', 'season': 1, 'tvdb_id': str(10 + i), 'mal_id': x, 'watched_episodes': 2,
+                  'mal_watched_eps': 0, 'total_episodes': None, 'on_list': False}
+                 for i, x in enumerate([x for x in sorted(mal.dataset.episodes) if x not in mal.mal_list][:3])]
+    failed = syncHandler.apply_updates(to_update, MalList('check', mal.url), profiles[0])
+    check(len(failed) == 0 and all(x.get('mal_id') in mal.mal_list for x in to_update),
+          "applies updates through the worker pool")
+    check(browser_pool._running == 0 and config.DRIVER is None, "doesn't start chrome")
+
+
+def main():
+    sys.path.insert(0, BENCHMARK_PATH)
+    from dataset import Dataset
+    from stubServers import MalStub
+
+    mal = MalStub(Dataset(200, 20))
+    mal.start()
+    data_path = tempfile.mkdtemp(prefix = 'plex-mal-sync-check-')
+    try:
+        os.mkdir(os.path.join(data_path, 'plex-mal-sync-webui'))
+        with open(os.path.join(data_path, 'plex-mal-sync-webui', 'config_data.json'), 'w') as f:
+            json.dump({'LIBRARY'               : 'Anime',
+                       'SERVER_TOKEN'          : 'check',
+                       'SERVER_URL'            : 'http://127.0.0.1:9',
+                       'MAL_USERNAME'          : 'check',
+                       'MAL_PASSWORD'          : 'check',
+                       'SYNC_TIME'             : '19:00',
+                       'MAL_UPDATER'           : 'http',
+                       'MAL_URL'               : mal.url,
+                       'MAL_UPDATE_WORKERS'    : 2,
+                       'MAL_UPDATES_PER_SECOND': 1000}, f)
+
+        os.environ['PROGRAM_DATA_PATH'] = data_path
+        run_checks(mal)
+    finally:
+        mal.stop()
+        shutil.rmtree(data_path, ignore_errors = True)
+
+    print(f"{len(failures)} checks failed" if failures else "All checks passed")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+import argparse
+import random
+import time
+from xml.sax.saxutils import quoteattr, escape
+
+# Ids are offset so the different services' ids can't be mixed up by accident
+TVDB_ID_START = 70000
+MAL_ID_START = 100000
+EPISODES_PER_SEASON = 12
+
+
+class Dataset:
+    def __init__(self, entries: int = 10000, shows: int = 1000, seed: int = 0):
+        """ Synthetic anime-list, plex library, anidb pages and MyAnimeList list that agree with each other.
+
+        The same arguments always produce the same data so runs can be compared.
+
+        :param entries: The number of anime elements in the anime-list XML.
+        :param shows: The number of shows in the plex library, these are taken from the start of the anime-list.
+        :param seed: Seed for the random choices.
+        """
+        rng = random.Random(seed)
+        now = int(time.time())
+
+        # List of (anidb id, tvdb id, season number, name) where season number may be 0 for specials
+        self.anime = []
+        # Tvdb ids to a dictionary of season numbers to anidb ids
+        self.series = {}
+        self._max_entries = entries
+        tvdb_id = TVDB_ID_START
+        while len(self.anime) < entries:
+            num_seasons = rng.choice((1, 1, 1, 2, 2, 3))
+            for season_number in range(1, num_seasons + 1):
+                self._add_anime(tvdb_id, season_number)
+            # Roughly one in five shows has specials which the sync skips
+            if rng.random() < 0.2:
+                self._add_anime(tvdb_id, 0)
+            tvdb_id += 1
+
+        # Anidb ids to mal ids, a few anidb pages have no MyAnimeList link
+        self.malids = {anidb_id: (None if rng.random() < 0.05 else str(MAL_ID_START + anidb_id))
+                       for anidb_id, _, _, _ in self.anime}
+        # Mal ids to the total number of episodes
+        self.episodes = {mal_id: EPISODES_PER_SEASON for mal_id in self.malids.values() if mal_id is not None}
+
+        # Plex shows as dictionaries of rating_key, tvdb_id, title and seasons where seasons maps
+        # season numbers to (episode count, watched episode count, last viewed timestamp) tuples
+        self.library = []
+        for rating_key, tvdb_key in enumerate(list(self.series)[:shows], start = 1):
+            seasons = {}
+            for season_number in self.series.get(tvdb_key):
+                watched = rng.choice((0, 0, rng.randint(1, EPISODES_PER_SEASON), EPISODES_PER_SEASON))
+                last_viewed_at = now - rng.randint(0, 90 * 24 * 3600) if watched > 0 else None
+                seasons[season_number] = (EPISODES_PER_SEASON, watched, last_viewed_at)
+
+            self.library.append({'rating_key': rating_key,
+                                 'tvdb_id'   : tvdb_key,
+                                 'title'     : f'Show {tvdb_key}',
+                                 'seasons'   : seasons})
+
+        # The MyAnimeList list has most watched seasons on it, some of them behind plex
+        self.mal_list = {}
+        for show in self.library:
+            for season_number, (_, watched, _) in show.get('seasons').items():
+                mal_id = self.malids.get(self.series.get(show.get('tvdb_id')).get(season_number))
+                if mal_id is None or watched == 0 or rng.random() < 0.2:
+                    continue
+
+                list_watched = rng.choice((watched, watched, rng.randint(0, watched)))
+                self.mal_list[mal_id] = {'anime_id'            : int(mal_id),
+                                         'status'              : 2 if list_watched == EPISODES_PER_SEASON else 1,
+                                         'num_watched_episodes': list_watched,
+                                         'anime_num_episodes'  : EPISODES_PER_SEASON}
+
+    def _add_anime(self, tvdb_id: int, season_number: int) -> None:
+        if len(self.anime) >= self._max_entries:
+            return
+
+        anidb_id = len(self.anime) + 1
+        self.anime.append((anidb_id, tvdb_id, season_number, f'Anime {anidb_id}'))
+        if season_number > 0:
+            self.series.setdefault(tvdb_id, {})[season_number] = anidb_id
+
+
+def write_anime_list_xml(dataset: Dataset, filepath: str) -> None:
+    """ Writes the dataset in the same format as ScudLee's anime-list-full.xml. """
+    with open(filepath, 'w', encoding = 'utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<anime-list>\n')
+        for anidb_id, tvdb_id, season_number, name in dataset.anime:
+            f.write(f'  <anime anidbid="{anidb_id}" tvdbid="{tvdb_id}" defaulttvdbseason="{season_number}" '
+                    f'episodeoffset="" tmdbid="" imdbid="">\n'
+                    f'    <name>{escape(name)}</name>\n'
+                    f'    <mapping-list>\n'
+                    f'      <mapping anidbseason="1" tvdbseason={quoteattr(str(season_number))}>;1-1;2-2;</mapping>\n'
+                    f'    </mapping-list>\n'
+                    f'  </anime>\n')
+        f.write('</anime-list>\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Generates a synthetic anime-list-full.xml")
+    parser.add_argument('filepath', help = "Where to write the XML file")
+    parser.add_argument('--entries', type = int, default = 10000, help = "Number of anime entries")
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    write_anime_list_xml(Dataset(args.entries, 0, args.seed), args.filepath)
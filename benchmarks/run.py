@@ -0,0 +1,234 @@
+""" Times the sync phases against local stand-ins for plex, MyAnimeList, anidb and the anime-list download.
+
+Every scenario runs in its own process with an empty data directory so the module singletons and
+peak memory of one scenario don't affect the next. Run from the repository root with:
+
+    python benchmarks/run.py --entries 10000 --shows 1000
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.dirname(BENCHMARK_PATH)
+SERVICES = ('plex', 'mal', 'anidb', 'github')
+
+
+# Scenarios, each returns a function to be timed after doing any setup that shouldn't be included
+
+def download_mapping():
+    import mapping
+    return mapping.download_tvdb_anidb_mapping
+
+
+def download_mapping_unchanged():
+    import mapping
+    mapping.download_tvdb_anidb_mapping()
+    return mapping.download_tvdb_anidb_mapping
+
+
+def resolve_mappings():
+    shows = _load_shows()
+    import syncHandler
+    return lambda: syncHandler.update_mal_tvdb_mappings(shows)
+
+
+def get_to_update():
+    shows = _load_shows()
+    import config
+    import syncHandler
+    from malList import MalList
+    syncHandler.update_mal_tvdb_mappings(shows)
+    mal_list = MalList(config.MAL_USERNAME)
+    return lambda: syncHandler.get_to_update(shows, mal_list)
+
+
+def full_sync():
+    import syncHandler
+    return lambda: syncHandler.do_sync(full = True)
+
+
+def incremental_sync():
+    import syncHandler
+    syncHandler.do_sync(full = True)
+    return syncHandler.do_sync
+
+
+def targeted_sync():
+    import syncHandler
+    syncHandler.do_sync(full = True)
+    # The seasons of a handful of shows as if they had just been watched and reported by the plex webhook
+    targets = {rating_key: {1, 2} for rating_key in range(1, 11)}
+    return lambda: syncHandler.do_sync(targets = targets)
+
+
+SCENARIOS = {x.__name__: x for x in (download_mapping, download_mapping_unchanged, resolve_mappings, get_to_update,
+                                     full_sync, incremental_sync, targeted_sync)}
+
+
+def _load_shows() -> list:
+    import config
+    import mapping
+    from plexConnection import PlexConnection
+    mapping.download_tvdb_anidb_mapping()
+    return PlexConnection(config.SERVER_URL, config.SERVER_TOKEN).get_library_snapshot("Anime").shows
+
+
+def get_stats(stubs: dict) -> dict:
+    """ Gets the request counts of every stub server. """
+    stats = {}
+    for service, url in stubs.items():
+        with urllib.request.urlopen(f'{url}/_stats') as response:
+            stats[service] = json.load(response)
+    return stats
+
+
+def get_peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS reports bytes
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_child(scenario: str, result_path: str) -> None:
+    """ Runs a scenario inside the scenario process and writes its measurements to result_path. """
+    sys.path.insert(0, REPO_PATH)
+    from flask import Flask
+    from flask_socketio import SocketIO
+    import config
+    # Updates are sent to the web page as they are made so a socketio server is needed, it has no clients
+    config.socketio = SocketIO(Flask(__name__))
+
+    stubs = json.loads(os.environ.get('BENCHMARK_STUBS'))
+    func = SCENARIOS.get(scenario)()
+
+    before = get_stats(stubs)
+    start = time.perf_counter()
+    func()
+    wall_time = time.perf_counter() - start
+    after = get_stats(stubs)
+
+    requests = {}
+    for service in stubs:
+        routes = {k: v - before.get(service).get(k, 0) for k, v in after.get(service).items()}
+        requests[service] = {k: v for k, v in routes.items() if v > 0}
+
+    with open(result_path, 'w') as f:
+        json.dump({'scenario'   : scenario,
+                   'wall_time'  : wall_time,
+                   'requests'   : requests,
+                   'peak_rss_mb': get_peak_rss_mb()}, f)
+
+
+def run_scenario(scenario: str, servers: dict, args) -> dict:
+    """ Runs a scenario in a new process with a new data directory. """
+    for server in servers.values():
+        server.reset()
+
+    data_path = tempfile.mkdtemp(prefix = 'plex-mal-sync-benchmark-')
+    try:
+        os.mkdir(os.path.join(data_path, 'plex-mal-sync-webui'))
+        with open(os.path.join(data_path, 'plex-mal-sync-webui', 'config_data.json'), 'w') as f:
+            json.dump({'LIBRARY'                  : 'Anime',
+                       'SERVER_TOKEN'             : 'benchmark',
+                       'SERVER_URL'               : servers.get('plex').url,
+                       'MAL_USERNAME'             : 'benchmark',
+                       'MAL_PASSWORD'             : 'benchmark',
+                       'SYNC_TIME'                : '19:00',
+                       'MAL_UPDATER'              : 'http',
+                       'MAL_URL'                  : servers.get('mal').url,
+                       'ANIDB_URL'                : servers.get('anidb').url,
+                       'MAPPING_XML_URL'          : servers.get('github').xml_url,
+                       'ANIDB_WORKERS'            : args.workers,
+                       'ANIDB_REQUESTS_PER_SECOND': args.rate,
+                       'MAL_UPDATE_WORKERS'       : args.workers,
+                       'MAL_UPDATES_PER_SECOND'   : args.rate}, f)
+
+        result_path = os.path.join(data_path, 'result.json')
+        env = dict(os.environ,
+                   PROGRAM_DATA_PATH = data_path,
+                   BENCHMARK_STUBS = json.dumps({k: v.url for k, v in servers.items()}))
+        output = None if args.verbose else subprocess.DEVNULL
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', scenario, result_path],
+                                 env = env, stdout = output, stderr = output)
+        if process.returncode != 0 or not os.path.exists(result_path):
+            return {'scenario': scenario, 'error': f'exited with code {process.returncode}'}
+
+        with open(result_path) as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(data_path, ignore_errors = True)
+
+
+def print_results(results: list) -> None:
+    print(f"{'scenario':<28}{'wall s':>10}{'peak rss mb':>13}" + ''.join(f'{x:>8}' for x in SERVICES))
+    for result in results:
+        if 'error' in result:
+            print(f"{result.get('scenario'):<28}{result.get('error')}")
+            continue
+
+        counts = [sum(result.get('requests').get(x, {}).values()) for x in SERVICES]
+        print(f"{result.get('scenario'):<28}{result.get('wall_time'):>10.3f}{result.get('peak_rss_mb'):>13.1f}"
+              + ''.join(f'{x:>8}' for x in counts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmarks the sync against local stub servers")
+    parser.add_argument('--entries', type = int, default = 10000, help = "Anime entries in the anime-list XML")
+    parser.add_argument('--shows', type = int, default = 1000, help = "Shows in the plex library")
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--latency-ms', type = float, default = 0, help = "Latency added to every stub response")
+    parser.add_argument('--workers', type = int, default = 4, help = "Anidb and MyAnimeList workers")
+    parser.add_argument('--rate', type = float, default = 1000, help = "Anidb and MyAnimeList requests per second")
+    parser.add_argument('--scenario', action = 'append', choices = list(SCENARIOS),
+                        help = "Scenario to run, can be given more than once. Runs every scenario by default")
+    parser.add_argument('--json', help = "Also write the results to this file to compare with later runs")
+    parser.add_argument('--verbose', action = 'store_true', help = "Show the output of the scenarios")
+    parser.add_argument('--child', nargs = 2, help = argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        run_child(*args.child)
+        return
+
+    from dataset import Dataset
+    from stubServers import PlexStub, MalStub, AnidbStub, MappingStub
+
+    start = time.perf_counter()
+    dataset = Dataset(args.entries, args.shows, args.seed)
+    xml_dir = tempfile.mkdtemp(prefix = 'plex-mal-sync-benchmark-xml-')
+    latency = args.latency_ms / 1000
+    servers = {'plex'  : PlexStub(dataset, latency),
+               'mal'   : MalStub(dataset, latency),
+               'anidb' : AnidbStub(dataset, latency),
+               'github': MappingStub(dataset, latency, os.path.join(xml_dir, 'anime-list-full.xml'))}
+    shutil.rmtree(xml_dir, ignore_errors = True)
+    print(f"Generated {len(dataset.anime)} anime, {len(dataset.library)} shows and {len(dataset.mal_list)} "
+          f"list entries in {time.perf_counter() - start:.1f}s")
+
+    for server in servers.values():
+        server.start()
+
+    results = []
+    try:
+        for scenario in args.scenario or list(SCENARIOS):
+            results.append(run_scenario(scenario, servers, args))
+    finally:
+        for server in servers.values():
+            server.stop()
+
+    print_results(results)
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'args'   : {k: v for k, v in vars(args).items() if k not in ('child', 'json')},
+                       'results': results}, f, indent = 2)
+
+
+if __name__ == '__main__':
+    main()
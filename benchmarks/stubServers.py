@@ -0,0 +1,310 @@
+import gzip
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+from xml.sax.saxutils import quoteattr
+
+from dataset import Dataset, write_anime_list_xml
+
+
+class StubResponse:
+    def __init__(self, route: str, status: int = 200, body: bytes = b'', content_type: str = 'text/html',
+                 headers: dict = None):
+        """ Response from a stub server.
+
+        :param route: Name the request is counted under in the server's stats.
+        """
+        self.route = route
+        self.status = status
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+
+
+class StubServer:
+    def __init__(self, dataset: Dataset, latency: float = 0):
+        """ Local http server standing in for one of the services the sync talks to.
+
+        Requests are counted by route and GET /_stats returns the counts as json.
+
+        :param dataset: The data the server is based on.
+        :param latency: Seconds added to every response to simulate a remote server.
+        """
+        self.dataset = dataset
+        self.latency = latency
+        self.requests = Counter()
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub._dispatch(self, 'GET')
+
+            def do_POST(self):
+                stub._dispatch(self, 'POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.reset()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    def start(self) -> None:
+        threading.Thread(target = self.httpd.serve_forever, daemon = True).start()
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset(self) -> None:
+        """ Puts back any data changed by requests and clears the stats. """
+        with self._lock:
+            self.requests.clear()
+
+    def handle(self, method: str, path: str, query: dict, headers, body: bytes) -> StubResponse:
+        return StubResponse('not found', 404)
+
+    def _dispatch(self, request: BaseHTTPRequestHandler, method: str) -> None:
+        url = urlsplit(request.path)
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length) if length > 0 else b''
+
+        if url.path == '/_stats':
+            with self._lock:
+                response = StubResponse('stats', body = json.dumps(dict(self.requests)).encode(),
+                                        content_type = 'application/json')
+        else:
+            if self.latency > 0:
+                time.sleep(self.latency)
+            response = self.handle(method, url.path, dict(parse_qsl(url.query, keep_blank_values = True)),
+                                   request.headers, body)
+            with self._lock:
+                self.requests[f'{method} {response.route}'] += 1
+
+        request.send_response(response.status)
+        request.send_header('Content-Type', response.content_type)
+        request.send_header('Content-Length', str(len(response.body)))
+        for k, v in response.headers.items():
+            request.send_header(k, v)
+        request.end_headers()
+        request.wfile.write(response.body)
+
+
+class PlexStub(StubServer):
+    """ Serves the library endpoints plexConnection uses with a single show library called Anime. """
+    SECTION_KEY = '1'
+
+    def reset(self) -> None:
+        super().reset()
+        self.shows = {show.get('rating_key'): show for show in self.dataset.library}
+
+    def handle(self, method, path, query, headers, body):
+        if path == '/':
+            return self._xml('server', '<MediaContainer friendlyName="benchmark" machineIdentifier="benchmark" '
+                                       'version="1.0.0"/>')
+
+        if path in ('/library', '/library/'):
+            return self._xml('library', '<MediaContainer title1="Plex Library"/>')
+
+        if path in ('/library/sections', '/library/sections/'):
+            return self._xml('sections', f'<MediaContainer size="1"><Directory key="{self.SECTION_KEY}" '
+                                         f'type="show" title="Anime" agent="com.plexapp.agents.thetvdb"/>'
+                                         f'</MediaContainer>')
+
+        if path == f'/library/sections/{self.SECTION_KEY}/all':
+            return self._section_items(query)
+
+        match = re.fullmatch(r'/library/metadata/(\d+)(/children)?', path)
+        if match and int(match.group(1)) in self.shows:
+            show = self.shows.get(int(match.group(1)))
+            if match.group(2):
+                return self._xml('metadata children', self._container(self._season_elements(show)))
+            return self._xml('metadata', self._container([self._show_element(show)]).replace(
+                '<MediaContainer ', '<MediaContainer librarySectionTitle="Anime" ', 1))
+
+        return StubResponse('not found', 404)
+
+    def _section_items(self, query: dict) -> StubResponse:
+        libtype = query.get('type')
+        if libtype == '2':
+            elements = (self._show_element(show) for show in self.shows.values())
+        elif libtype == '3':
+            elements = (x for show in self.shows.values() for x in self._season_elements(show))
+        elif libtype == '4':
+            # lastViewedAt>>=since is parsed as a key of lastViewedAt>> with a value of since
+            since = int(query.get('lastViewedAt>>') or 0)
+            elements = (x for show in self.shows.values() for x in self._episode_elements(show, since))
+        else:
+            return StubResponse('not found', 404)
+
+        # Page the items the same way plex does with the container start and size arguments
+        items = list(elements)
+        start = int(query.get('X-Plex-Container-Start', 0))
+        size = int(query.get('X-Plex-Container-Size', len(items)))
+        page = items[start:start + size]
+        return self._xml(f'section type={libtype}', self._container(page, len(items), start))
+
+    @staticmethod
+    def _show_element(show: dict) -> str:
+        return (f'<Directory ratingKey="{show.get("rating_key")}" key="/library/metadata/{show.get("rating_key")}/children" '
+                f'guid="com.plexapp.agents.thetvdb://{show.get("tvdb_id")}?lang=en" type="show" '
+                f'title={quoteattr(show.get("title"))} childCount="{len(show.get("seasons"))}"/>')
+
+    @staticmethod
+    def _season_elements(show: dict) -> list:
+        elements = []
+        for season_number, (leaf_count, viewed, last_viewed_at) in show.get('seasons').items():
+            viewed_at = f' lastViewedAt="{last_viewed_at}"' if last_viewed_at else ''
+            elements.append(f'<Directory ratingKey="{show.get("rating_key") * 100 + season_number}" '
+                            f'parentRatingKey="{show.get("rating_key")}" type="season" index="{season_number}" '
+                            f'title="Season {season_number}" leafCount="{leaf_count}" '
+                            f'viewedLeafCount="{viewed}"{viewed_at}/>')
+        return elements
+
+    @staticmethod
+    def _episode_elements(show: dict, since: int) -> list:
+        # Only the last watched episode of each season is needed to find the changed shows
+        return [f'<Video ratingKey="{show.get("rating_key") * 10000 + season_number * 100 + viewed}" type="episode" '
+                f'grandparentRatingKey="{show.get("rating_key")}" index="{viewed}" lastViewedAt="{last_viewed_at}"/>'
+                for season_number, (_, viewed, last_viewed_at) in show.get('seasons').items()
+                if last_viewed_at is not None and last_viewed_at >= since]
+
+    @staticmethod
+    def _container(elements: list, total: int = None, offset: int = 0) -> str:
+        total = len(elements) if total is None else total
+        return (f'<MediaContainer size="{len(elements)}" totalSize="{total}" offset="{offset}">'
+                + ''.join(elements) + '</MediaContainer>')
+
+    @staticmethod
+    def _xml(route: str, text: str) -> StubResponse:
+        return StubResponse(route, body = f'<?xml version="1.0" encoding="UTF-8"?>{text}'.encode(),
+                            content_type = 'text/xml;charset=utf-8')
+
+
+class MalStub(StubServer):
+    """ Serves the MyAnimeList login, list json and list edit endpoints. """
+    CSRF_TOKEN = 'benchmark-csrf-token'
+    SESSION_COOKIE = 'MALSESSIONID'
+    PROFILE_LINK = '<a class="header-profile-link" href="/profile/benchmark">benchmark</a>'
+    PAGE_SIZE = 300
+
+    def reset(self) -> None:
+        super().reset()
+        self.mal_list = {k: dict(v) for k, v in self.dataset.mal_list.items()}
+        self.version = 0
+
+    def handle(self, method, path, query, headers, body):
+        if path == '/login.php':
+            if method != 'POST':
+                return self._html('login', '')
+            response = self._html('login', self.PROFILE_LINK)
+            response.headers['Set-Cookie'] = f'{self.SESSION_COOKIE}=benchmark; Path=/; HttpOnly'
+            return response
+
+        if path == '/panel.php':
+            logged_in = f'{self.SESSION_COOKIE}=benchmark' in headers.get('Cookie', '')
+            return self._html('panel', self.PROFILE_LINK if logged_in else '')
+
+        if re.fullmatch(r'/animelist/[^/]+/load\.json', path) and method == 'GET':
+            return self._load_json(query, headers)
+
+        match = re.fullmatch(r'/anime/(\d+)', path)
+        if match and method == 'GET':
+            total = self.dataset.episodes.get(match.group(1))
+            if total is None:
+                return StubResponse('anime', 404)
+            return self._html('anime', f'<span id="curEps">{total}</span>')
+
+        match = re.fullmatch(r'/ownlist/anime/(add|edit)\.json', path)
+        if match and method == 'POST':
+            return self._update(match.group(1), json.loads(body or b'{}'))
+
+        return StubResponse('not found', 404)
+
+    def _load_json(self, query: dict, headers) -> StubResponse:
+        etag = f'"list-{self.version}"'
+        offset = int(query.get('offset', 0))
+        if offset == 0 and headers.get('If-None-Match') == etag:
+            return StubResponse('load.json', 304, headers = {'ETag': etag})
+
+        entries = [self.mal_list.get(k) for k in sorted(self.mal_list)][offset:offset + self.PAGE_SIZE]
+        return StubResponse('load.json', body = json.dumps(entries).encode(), content_type = 'application/json',
+                            headers = {'ETag': etag})
+
+    def _update(self, action: str, payload: dict) -> StubResponse:
+        if payload.get('csrf_token') != self.CSRF_TOKEN:
+            return StubResponse(f'{action}.json', 403)
+
+        mal_id = str(payload.get('anime_id'))
+        # MyAnimeList rejects adding anime that are already on the list and editing ones that aren't
+        if (action == 'add') == (mal_id in self.mal_list) or mal_id not in self.dataset.episodes:
+            return StubResponse(f'{action}.json', 400)
+
+        with self._lock:
+            self.mal_list[mal_id] = {'anime_id'            : int(mal_id),
+                                     'status'              : payload.get('status'),
+                                     'num_watched_episodes': payload.get('num_watched_episodes'),
+                                     'anime_num_episodes'  : self.dataset.episodes.get(mal_id)}
+            self.version += 1
+
+        return StubResponse(f'{action}.json', body = b'{}', content_type = 'application/json')
+
+    def _html(self, route: str, content: str) -> StubResponse:
+        return StubResponse(route, body = (f'<html><head><meta name="csrf_token" content="{self.CSRF_TOKEN}">'
+                                           f'</head><body>{content}</body></html>').encode())
+
+
+class AnidbStub(StubServer):
+    """ Serves anidb anime pages that link to their MyAnimeList page. """
+
+    def handle(self, method, path, query, headers, body):
+        match = re.fullmatch(r'/anime/(\d+)', path)
+        if match is None or int(match.group(1)) not in self.dataset.malids:
+            return StubResponse('not found', 404)
+
+        mal_id = self.dataset.malids.get(int(match.group(1)))
+        link = f'<a href="https://myanimelist.net/anime/{mal_id}">MyAnimeList</a>' if mal_id is not None else ''
+        return StubResponse('anime', body = f'<html><body><h1>Anime {match.group(1)}</h1>{link}</body></html>'.encode())
+
+
+class MappingStub(StubServer):
+    """ Serves the anime-list XML with the ETag and gzip handling of raw.githubusercontent.com. """
+    PATH = '/anime-list-full.xml'
+
+    def __init__(self, dataset: Dataset, latency: float = 0, xml_filepath: str = None):
+        """ :param xml_filepath: Where the generated XML is written before it is loaded into memory. """
+        super().__init__(dataset, latency)
+        write_anime_list_xml(dataset, xml_filepath)
+        with open(xml_filepath, 'rb') as f:
+            self.xml = f.read()
+        self.xml_gzip = gzip.compress(self.xml)
+        self.etag = f'"anime-list-{len(dataset.anime)}-{len(self.xml)}"'
+
+    @property
+    def xml_url(self) -> str:
+        return f'{self.url}{self.PATH}'
+
+    def handle(self, method, path, query, headers, body):
+        if path != self.PATH:
+            return StubResponse('not found', 404)
+
+        if headers.get('If-None-Match') == self.etag:
+            return StubResponse('anime-list', 304, headers = {'ETag': self.etag})
+
+        if 'gzip' in (headers.get('Accept-Encoding') or ''):
+            return StubResponse('anime-list', body = self.xml_gzip, content_type = 'text/xml',
+                                headers = {'ETag': self.etag, 'Content-Encoding': 'gzip'})
+
+        return StubResponse('anime-list', body = self.xml, content_type = 'text/xml', headers = {'ETag': self.etag})
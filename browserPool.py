@@ -0,0 +1,93 @@
+import threading
+import time
+
+import config
+from driver import Driver
+from utils import log
+
+
+class BrowserPool:
+    def __init__(self, size: int = None, idle_timeout: float = None):
+        """ Pool of warm browsers that are only started when something needs one.
+
+        Released browsers are kept alive so the next sync can reuse them and are quit once
+        they have been idle for longer than the idle timeout.
+
+        :param size: The maximum number of browsers running at once.
+        :param idle_timeout: Seconds an unused browser is kept alive for.
+        """
+        self.size = size or config.BROWSER_POOL_SIZE
+        self.idle_timeout = idle_timeout if idle_timeout is not None else config.BROWSER_IDLE_TIMEOUT_MINUTES * 60
+        self._idle = []
+        self._running = 0
+        self._condition = threading.Condition()
+        self._reaper = None
+
+    def acquire(self) -> Driver:
+        """ Gets a healthy browser from the pool, starting a new one if none are idle.
+
+        Blocks while the pool is at its maximum size and every browser is in use.
+        """
+        with self._condition:
+            while True:
+                while len(self._idle) > 0:
+                    driver, _ = self._idle.pop()
+                    if driver.is_alive():
+                        return driver
+
+                    log("Discarding unresponsive browser")
+                    self._quit(driver)
+
+                if self._running < self.size:
+                    self._running += 1
+                    break
+
+                self._condition.wait()
+
+        try:
+            return Driver()
+        except Exception:
+            with self._condition:
+                self._running -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, driver: Driver) -> None:
+        """ Returns a browser to the pool so it can be reused until it times out. """
+        with self._condition:
+            self._idle.append((driver, time.monotonic()))
+            self._condition.notify()
+
+            if self._reaper is None:
+                self._reaper = threading.Thread(target = self._reap_idle, daemon = True)
+                self._reaper.start()
+
+    def _quit(self, driver: Driver) -> None:
+        self._running -= 1
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        self._condition.notify()
+
+    def _reap_idle(self) -> None:
+        """ Quits browsers that have been idle for longer than the idle timeout. """
+        while True:
+            time.sleep(min(60, max(1, self.idle_timeout)))
+            with self._condition:
+                now = time.monotonic()
+                for driver, last_used in list(self._idle):
+                    if now - last_used >= self.idle_timeout:
+                        log("Closing idle browser")
+                        self._idle.remove((driver, last_used))
+                        self._quit(driver)
+
+    def close_all(self) -> None:
+        """ Quits every idle browser. """
+        with self._condition:
+            while len(self._idle) > 0:
+                driver, _ = self._idle.pop()
+                self._quit(driver)
+
+
+browser_pool = BrowserPool()
@@ -14,9 +14,14 @@ if not os.path.exists(DATA_PATH):
 
 TVDBID_ANIDBID_XML_FILEPATH = os.path.join(DATA_PATH, 'tvdbid_to_anidbid.xml')
 TVDBID_ANIDBID_FILEPATH = os.path.join(DATA_PATH, 'tvdbid_to_anidbid.json')
+TVDBID_ANIDBID_META_FILEPATH = os.path.join(DATA_PATH, 'tvdbid_to_anidbid_meta.json')
 TVDBID_MALID_FILEPATH = os.path.join(DATA_PATH, 'tvdbid_to_malid.json')
 MAPPING_ERRORS_FILEPATH = os.path.join(DATA_PATH, 'mapping_errors.json')
+MAPPING_DB_FILEPATH = os.path.join(DATA_PATH, 'mappings.db')
 RECENT_UPDATES_PATH = os.path.join(DATA_PATH, 'recent_updates.json')
+SYNC_STATE_PATH = os.path.join(DATA_PATH, 'sync_state.json')
+SYNC_PLAN_PATH = os.path.join(DATA_PATH, 'sync_plan.json')
+ANIDB_MALID_CACHE_PATH = os.path.join(DATA_PATH, 'anidbid_to_malid.json')
 CONFIG_PATH = os.path.join(DATA_PATH, 'config_data.json')
 DRIVER = None
 
@@ -27,7 +32,9 @@ if not os.path.exists(CONFIG_PATH):
                    'SERVER_URL'  : None,
                    'MAL_USERNAME': None,
                    'MAL_PASSWORD': None,
-                   'SYNC_TIME'   : '19:00'}, f)
+                   'SYNC_TIME'   : '19:00',
+                   'FULL_SYNC_INTERVAL_HOURS': 168,
+                   'MAL_UPDATER' : 'selenium'}, f)
     print("Please fill in the values in the config file")
     sys.exit()
 
@@ -46,7 +53,63 @@ SERVER_TOKEN = data.get('SERVER_TOKEN')
 SERVER_URL = data.get('SERVER_URL')
 MAL_USERNAME = data.get('MAL_USERNAME')
 MAL_PASSWORD = data.get('MAL_PASSWORD')
-SYNC_TIME = '19:00'
+# Daily times incremental syncs run at, either a single time such as 19:00 or a list of times
+SYNC_TIME = data.get('SYNC_TIME', '19:00')
+if isinstance(SYNC_TIME, list):
+    SYNC_TIME = ','.join(SYNC_TIME)
+# More sync schedules as daily times, intervals such as "every 6h" or cron expressions such as "0 */4 * * *"
+SYNC_SCHEDULE = ([SYNC_TIME] if SYNC_TIME else []) + list(data.get('SYNC_SCHEDULE', []))
+# Schedules for syncs that always scan the whole library on top of the FULL_SYNC_INTERVAL_HOURS check
+FULL_SYNC_SCHEDULE = list(data.get('FULL_SYNC_SCHEDULE', []))
+# Up to this many minutes are added to every scheduled sync at random
+SYNC_JITTER_MINUTES = float(data.get('SYNC_JITTER_MINUTES', 0))
+# Hours an unfinished sync's updates are kept to be resumed by the next sync before they are worked out again
+SYNC_PLAN_TTL_HOURS = float(data.get('SYNC_PLAN_TTL_HOURS', 12))
+# More (library, MyAnimeList account) pairs to sync alongside the one above, each is a dictionary with a name,
+# LIBRARY, MAL_USERNAME, MAL_PASSWORD and optionally SERVER_URL and SERVER_TOKEN
+PROFILES = list(data.get('PROFILES', []))
+# Hours between full library scans, the syncs in between only look at shows watched since the last sync
+FULL_SYNC_INTERVAL_HOURS = float(data.get('FULL_SYNC_INTERVAL_HOURS', 168))
+# Either selenium to update MyAnimeList through chrome or http to post the list updates directly
+MAL_UPDATER = data.get('MAL_UPDATER', 'selenium')
+# Limits for fetching the anidb pages used to find mal ids
+ANIDB_WORKERS = int(data.get('ANIDB_WORKERS', 2))
+ANIDB_REQUESTS_PER_SECOND = float(data.get('ANIDB_REQUESTS_PER_SECOND', 0.5))
+# Browsers are only started when needed and are kept alive between syncs until they have been idle this long
+BROWSER_POOL_SIZE = int(data.get('BROWSER_POOL_SIZE', 1))
+BROWSER_IDLE_TIMEOUT_MINUTES = float(data.get('BROWSER_IDLE_TIMEOUT_MINUTES', 30))
+# Fast mode stops browsers waiting for or downloading images, fonts and anything from hosts not in the allowed hosts
+BROWSER_FAST_MODE = str(data.get('BROWSER_FAST_MODE', True)).lower() == 'true'
+BROWSER_ALLOWED_HOSTS = list(data.get('BROWSER_ALLOWED_HOSTS', ['myanimelist.net', '*.myanimelist.net']))
+# Minimum seconds between screenshots of the sync's browser, every viewer shares the latest one
+SCREENSHOT_INTERVAL_SECONDS = float(data.get('SCREENSHOT_INTERVAL_SECONDS', 2))
+# Number of logged in sessions updating MyAnimeList at once and the rate they share
+MAL_UPDATE_WORKERS = int(data.get('MAL_UPDATE_WORKERS', 1))
+MAL_UPDATES_PER_SECOND = float(data.get('MAL_UPDATES_PER_SECOND', 1))
+# The rate limiters wait for the time between requests so a rate of zero or below would never allow one
+invalid_rates = [k for k, v in [('ANIDB_REQUESTS_PER_SECOND', ANIDB_REQUESTS_PER_SECOND),
+                                ('MAL_UPDATES_PER_SECOND', MAL_UPDATES_PER_SECOND)] if not v > 0]
+if len(invalid_rates) > 0:
+    print("Please set the following config values above 0: " + ", ".join(invalid_rates))
+    sys.exit()
+# The saved copy of the MyAnimeList list is reused without any requests until it is this old
+MAL_LIST_MAX_AGE_HOURS = float(data.get('MAL_LIST_MAX_AGE_HOURS', 6))
+# Shows watched in plex are synced once no episodes of them have been watched for this long, or once the
+# first watched episode has waited the max delay, so binge watching a season becomes a single update
+WEBHOOK_DEBOUNCE_MINUTES = float(data.get('WEBHOOK_DEBOUNCE_MINUTES', 30))
+WEBHOOK_MAX_DELAY_MINUTES = float(data.get('WEBHOOK_MAX_DELAY_MINUTES', 120))
+# When set the plex webhook url must include ?token= with this value
+WEBHOOK_TOKEN = data.get('WEBHOOK_TOKEN')
+# Optional offline titles dump used alongside the anime-list names to suggest mal ids for mapping errors, either
+# anidb's anime-titles.dat or the anime-offline-database json, optionally gzipped
+TITLE_DUMP_PATH = data.get('TITLE_DUMP_PATH', '')
+# Mapping errors whose best title match scores at least this (out of 1) are mapped automatically, above 1 turns it off
+TITLE_MATCH_AUTO_APPLY_SCORE = float(data.get('TITLE_MATCH_AUTO_APPLY_SCORE', 0.95))
+# The services synced with, these can be pointed at local servers for testing and benchmarks
+MAL_URL = data.get('MAL_URL', 'https://myanimelist.net')
+ANIDB_URL = data.get('ANIDB_URL', 'https://anidb.net')
+MAPPING_XML_URL = data.get('MAPPING_XML_URL',
+                           'https://raw.githubusercontent.com/ScudLee/anime-lists/master/anime-list-full.xml')
 
 # Changing
 latest_log = ""
@@ -0,0 +1,49 @@
+import threading
+import uuid
+
+
+class DashboardState:
+    def __init__(self):
+        """ In-memory copy of everything shown on the dashboard.
+
+        The sync and the mapping module update it as things change so the dashboard never has to
+        read the data files. Every change bumps the version which is used in the ETag along with a value that
+        is new every time the program starts, so an ETag from before a restart never matches.
+        """
+        self._lock = threading.Lock()
+        self.boot_id = uuid.uuid4().hex[:12]
+        self.version = 0
+        self.num_errors = None
+        self.recent_updates = None
+        self.next_run = None
+        self.sync_running = False
+
+    @property
+    def etag(self) -> str:
+        return f'state-{self.boot_id}-{self.version}'
+
+    def update(self, **changes) -> None:
+        """ Sets the given fields and bumps the version if any of them changed. """
+        with self._lock:
+            changed = False
+            for k, v in changes.items():
+                if getattr(self, k) != v:
+                    setattr(self, k, v)
+                    changed = True
+
+            if changed:
+                self.version += 1
+
+    def is_loaded(self, field: str) -> bool:
+        return getattr(self, field) is not None
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {'num_errors'    : self.num_errors,
+                    'recent_updates': dict(self.recent_updates or {}),
+                    'next_run'      : self.next_run,
+                    'sync_running'  : self.sync_running,
+                    'version'       : self.version}
+
+
+dashboard_state = DashboardState()
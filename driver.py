@@ -1,4 +1,3 @@
-import time
 from typing import Optional
 
 import selenium.common
@@ -6,15 +5,29 @@ from colorama import Fore
 from selenium import webdriver
 from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver.common.by import By
+from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support import expected_conditions as ec
 from selenium.webdriver.support.wait import WebDriverWait
 
+import config
+import malSession
 import mapping
+import metrics
 from config import MAL_USERNAME, MAL_PASSWORD
 from utils import log
 import syncHandler
 
+# Seconds between checks of the page while waiting for an element
+POLL_INTERVAL = 0.1
+# Resources that are never downloaded in fast mode
+BLOCKED_URLS = ['*.png', '*.jpg', '*.jpeg', '*.gif', '*.webp', '*.svg', '*.ico', '*.woff', '*.woff2', '*.ttf',
+                '*.mp4', '*.webm']
+# The privacy notices that may cover a MyAnimeList page, the larger one first
+PRIVACY_NOTICE_SELECTORS = ('.details_save--1ja7w', '.intro_acceptAll--23PPA')
+# The small privacy notice shown the first time MyAnimeList is loaded is only found as the first button on the page
+FIRST_PAGE_NOTICE_SELECTOR = 'button'
+
 
 class Driver:
     def __init__(self):
@@ -28,23 +41,70 @@ class Driver:
 
         # Remove unwanted logs
         chrome_options.add_argument("--log-level=3")
-        self.driver = webdriver.Chrome(chrome_options = chrome_options)
-        self.wait = WebDriverWait(self.driver, 10)
+        capabilities = DesiredCapabilities.CHROME.copy()
+        if config.BROWSER_FAST_MODE:
+            # Pages are ready to use once the DOM has loaded without waiting for images and iframes
+            capabilities['pageLoadStrategy'] = 'eager'
+            chrome_options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+            # Hosts that aren't allowed fail to resolve which stops ads, trackers and third party privacy notices
+            rules = ', '.join(f'EXCLUDE {x}' for x in config.BROWSER_ALLOWED_HOSTS)
+            chrome_options.add_argument(f'--host-resolver-rules=MAP * ~NOTFOUND, {rules}')
+
+        with metrics.timed('browser_start'):
+            self.driver = webdriver.Chrome(chrome_options = chrome_options, desired_capabilities = capabilities)
+        self.wait = WebDriverWait(self.driver, 10, poll_frequency = POLL_INTERVAL)
+        self.username = MAL_USERNAME
+        self.password = MAL_PASSWORD
+        # Whether the first page of the browser session, which may show an extra privacy notice, has been loaded
+        self.privacy_notices_handled = False
+
+        if config.BROWSER_FAST_MODE:
+            try:
+                self.driver.execute_cdp_cmd('Network.enable', {})
+                self.driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': BLOCKED_URLS})
+            except WebDriverException as e:
+                log(f"Unable to block fonts and media in the browser: {e}")
         log(f"Web driver started", Fore.GREEN)
 
+    def set_account(self, username: str, password: str) -> None:
+        """ Sets the MyAnimeList account to log in as, dropping the session of the previous account if it changes. """
+        if username != self.username:
+            self.clear_cookies()
+            self.privacy_notices_handled = False
+        self.username = username
+        self.password = password
+
+    def clear_cookies(self) -> None:
+        """ Deletes the cookies of every site, not only the one the browser is on. """
+        try:
+            self.driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+        except WebDriverException:
+            # Selenium can only delete the cookies of the current site so make sure that is MyAnimeList
+            self.get("https://myanimelist.net/robots.txt")
+            self.driver.delete_all_cookies()
+
     def get(self, url):
         """ Loads a given url with the chromedriver. """
-        self.driver.get(url)
+        with metrics.timed('browser_page_load'):
+            self.driver.get(url)
 
     def get_html(self, url = None):
         """ Gets the page source of a given url. """
         if url is not None:
-            self.driver.get(url)
+            self.get(url)
 
         return self.driver.page_source
 
-    def save_screenshot(self):
-        return self.driver.save_screenshot('screenshot.png')
+    def get_screenshot_as_png(self) -> Optional[bytes]:
+        """ Takes a screenshot of the current page in memory.
+
+        :return: The screenshot as png bytes or None if the browser couldn't take one.
+        """
+        try:
+            return self.driver.get_screenshot_as_png()
+        except WebDriverException as e:
+            log(f"Unable to take a screenshot of the browser: {e}")
+            return None
 
     def send_keys(self, selector, keys):
         """ Sends keys to a given element.
@@ -77,24 +137,24 @@ class Driver:
 
         :param css_selector: The css selector to locate the target element.
         :param log_click_error: Whether or not to log when a click fails.
+        :return: True if the element was clicked.
         """
-        try:
-            self.wait.until(ec.element_to_be_clickable((By.CSS_SELECTOR, css_selector)))
-            ele = self.find_element(css_selector)
-
-            attempts = 0
-            while attempts < 5:
-                try:
-                    attempts += 1
-                    ele.click()
-                except WebDriverException:
-                    time.sleep(1)
-                    continue
-                break
+        def try_click(driver) -> bool:
+            element = ec.element_to_be_clickable((By.CSS_SELECTOR, css_selector))(driver)
+            if not element:
+                return False
+            element.click()
+            return True
 
+        try:
+            # Clicks that fail because the element is covered or has been replaced are tried again on the next poll
+            WebDriverWait(self.driver, 10, poll_frequency = POLL_INTERVAL,
+                          ignored_exceptions = (WebDriverException,)).until(try_click)
+            return True
         except TimeoutException:
             if log_click_error:
                 log(f"Failed to click element. {css_selector}")
+            return False
 
     def wait_for(self, css_selector):
         """ Waits for an element to be loaded or become visible on the webpage.
@@ -115,33 +175,86 @@ class Driver:
             return False
 
     def accept_privacy_notices(self):
-        # Larger privacy notice
-        if self.element_exists('.details_save--1ja7w'):
-            self.click('.details_save--1ja7w', False)
-        # Click the medium privacy notice
-        if self.element_exists('.intro_acceptAll--23PPA'):
-            self.click('.intro_acceptAll--23PPA', False)
+        """ Accepts any privacy notices covering the page, these can appear on any page not only the first. """
+        selectors = PRIVACY_NOTICE_SELECTORS
+        if not self.privacy_notices_handled:
+            selectors += (FIRST_PAGE_NOTICE_SELECTOR,)
+            self.privacy_notices_handled = True
 
-        # First small privacy notice
-        if self.element_exists('button'):
-            self.click('button', False)
+        for css_selector in selectors:
+            if self.element_exists(css_selector):
+                self.click(css_selector, False)
+
+    def restore_session(self) -> bool:
+        """ Logs in with the cookies saved by a previous login if they still work.
+
+        :return: True if the saved session is still logged in.
+        """
+        cookies = malSession.load_cookies(self.username)
+        if len(cookies) == 0:
+            return False
+
+        # Cookies can only be added to the site that is loaded
+        self.get("https://myanimelist.net/robots.txt")
+        for cookie in cookies:
+            try:
+                self.driver.add_cookie(cookie)
+            except WebDriverException:
+                continue
+
+        self.get(f"https://myanimelist.net{malSession.SESSION_PROBE_PATH}")
+        if not self.login_successful():
+            log("Saved MyAnimeList session has expired")
+            self.driver.delete_all_cookies()
+            malSession.clear_cookies(self.username)
+            return False
+
+        log(f"Restored MyAnimeList session for user {self.username}", Fore.GREEN)
+        return True
+
+    def is_logged_in(self) -> bool:
+        """ Checks whether the browser is still logged in from an earlier sync, without loading a page if it has
+        never been to MyAnimeList.
+        """
+        try:
+            if 'myanimelist.net' not in self.driver.current_url:
+                return False
+        except WebDriverException:
+            return False
+
+        self.get(f"https://myanimelist.net{malSession.SESSION_PROBE_PATH}")
+        return self.login_successful()
 
     def login_myanimelist(self, attempts: int = 1):
+        if attempts == 1:
+            if self.is_logged_in():
+                log(f"Already logged in as user {self.username}", Fore.GREEN)
+                return True
+            if self.restore_session():
+                return True
+
         if attempts < 5:
             log(f"Logging into MyAnimeList attempt: {attempts}")
             self.get(f"https://myanimelist.net/login.php?from=%2F")
             self.accept_privacy_notices()
 
+            # MyAnimeList sends users that are already logged in away from the login form
+            if not self.element_exists('#loginUserName') and self.login_successful():
+                log(f"Already logged in as user {self.username}", Fore.GREEN)
+                malSession.save_cookies(self.username, self.driver.get_cookies())
+                return True
+
             # Enter login information
-            self.send_keys('#loginUserName', MAL_USERNAME)
-            self.send_keys('#login-password', MAL_PASSWORD)
+            self.send_keys('#loginUserName', self.username)
+            self.send_keys('#login-password', self.password)
 
             self.click('.pt16 .btn-form-submit')  # Click login button
 
             if not self.login_successful():
                 return self.login_myanimelist(attempts + 1)
 
-            log(f"Logged in successfully as user {MAL_USERNAME}", Fore.GREEN)
+            log(f"Logged in successfully as user {self.username}", Fore.GREEN)
+            malSession.save_cookies(self.username, self.driver.get_cookies())
             return True
 
         log(f"MyAnimeList login failed")
@@ -179,13 +292,23 @@ class Driver:
         self.send_keys('#myinfo_watchedeps', episodes_seen_value)
 
         # Click add or update
-        if self.element_exists('.js-anime-add-button'):
-            self.click('.js-anime-add-button')
-        else:
-            self.click('.js-anime-update-button')
+        save_button = '.js-anime-add-button' if self.element_exists('.js-anime-add-button') else '.js-anime-update-button'
+        if not self.click(save_button):
+            # A privacy notice shown after the page loaded may be covering the button
+            self.accept_privacy_notices()
+            if not self.click(save_button):
+                log(f"Failed to save {series.get('title')} season {series.get('season')}")
+                return None
 
         return status
 
+    def is_alive(self) -> bool:
+        """ Checks that the browser is still responding to commands. """
+        try:
+            return self.driver.current_url is not None
+        except WebDriverException:
+            return False
+
     def quit(self):
         """ Close the driver. """
         self.driver.quit()
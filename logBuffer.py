@@ -0,0 +1,87 @@
+import sys
+import threading
+import time
+from collections import deque
+
+import config
+
+# Number of log lines kept in memory for clients catching up
+BUFFER_SIZE = 1000
+# Minimum seconds between batches of log lines sent to the web page
+EMIT_INTERVAL = 0.5
+
+
+class LogBuffer:
+    def __init__(self, size: int = BUFFER_SIZE, emit_interval: float = EMIT_INTERVAL):
+        """ Bounded in-memory buffer of log lines that are sent to the web page in batches.
+
+        Every line gets an increasing cursor so clients can ask for the lines after the last one they saw.
+
+        :param size: The number of lines kept.
+        :param emit_interval: Minimum seconds between batches sent over socketio.
+        """
+        self.emit_interval = emit_interval
+        self._lines = deque(maxlen = size)
+        self._cursor = 0
+        self._emitted_cursor = 0
+        self._condition = threading.Condition()
+        self._emitter = None
+
+    @property
+    def cursor(self) -> int:
+        """ The cursor of the latest line. """
+        return self._cursor
+
+    def append(self, text: str) -> None:
+        with self._condition:
+            self._cursor += 1
+            self._lines.append({'cursor': self._cursor, 'time': time.time(), 'log': text})
+            self._condition.notify()
+
+            if self._emitter is None:
+                self._emitter = threading.Thread(target = self._emit_batches, daemon = True)
+                self._emitter.start()
+
+    def since(self, cursor: int, limit: int = BUFFER_SIZE) -> dict:
+        """ Gets the lines after a cursor.
+
+        :param cursor: The cursor of the last line the client has.
+        :param limit: The maximum number of lines to return.
+        :return: Dictionary of the lines, the latest cursor and whether lines were missed because they
+                 had already left the buffer.
+        """
+        with self._condition:
+            lines = [x for x in self._lines if x.get('cursor') > cursor][:limit]
+            oldest = self._lines[0].get('cursor') if len(self._lines) > 0 else self._cursor + 1
+            return {'logs'     : lines,
+                    'cursor'   : lines[-1].get('cursor') if len(lines) > 0 else max(cursor, self._cursor),
+                    'truncated': cursor + 1 < oldest}
+
+    def tail(self, count: int) -> dict:
+        """ Gets the latest lines.
+
+        :param count: The number of lines to return.
+        :return: Dictionary of the lines and the latest cursor.
+        """
+        with self._condition:
+            lines = list(self._lines)[-count:] if count > 0 else []
+            return {'logs': lines, 'cursor': self._cursor, 'truncated': False}
+
+    def _emit_batches(self) -> None:
+        """ Sends the new lines as one socketio event at most once per emit interval. """
+        while True:
+            with self._condition:
+                while self._emitted_cursor == self._cursor:
+                    self._condition.wait()
+
+                batch = self.since(self._emitted_cursor)
+                self._emitted_cursor = batch.get('cursor')
+
+            sys.stdout.flush()
+            if config.socketio is not None:
+                config.socketio.emit('new_logs', batch, namespace = '/socket')
+
+            time.sleep(self.emit_interval)
+
+
+log_buffer = LogBuffer()
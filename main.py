@@ -1,83 +1,259 @@
-from datetime import datetime
-import time
+import csv
+import io
+import json
 
-import schedule
-from flask import Flask, render_template, jsonify, request
-import threading
+from flask import Flask, render_template, jsonify, request, Response, make_response
 import mapping
+import metrics
 import utils
-from config import MAPPING_ERRORS_FILEPATH, SYNC_TIME
 import config
 from syncHandler import do_sync
-from flask_socketio import SocketIO
+from syncJobs import sync_queue
+from logBuffer import log_buffer
+from dashboardState import dashboard_state
+from scheduler import scheduler
+from profiles import profiles
+from plexWebhook import parse_scrobble, scrobble_debouncer
+from screenshotStream import screenshot_stream, SCREENSHOT_ROOM
+from titleIndex import title_matcher
+from flask_socketio import SocketIO, join_room, leave_room
 
 app = Flask(__name__)
 socketio = SocketIO(app)
 config.socketio = socketio
 
+CSV_HEADER = ('tvdb_id', 'season', 'mal_id')
 
-def sync_runner():
-    if not config.sync_running:
-        config.sync_running = True
-        socketio.emit('update_sync_running', {'sync_running': True}, namespace = '/socket')
-        do_sync()
-        config.sync_running = False
-        socketio.emit('update_sync_running', {'sync_running': False}, namespace = '/socket')
 
+def update_sync_running(sync_running: bool):
+    config.sync_running = sync_running
+    dashboard_state.update(sync_running = sync_running)
+    socketio.emit('update_sync_running', {'sync_running': sync_running}, namespace = '/socket')
 
-def start_schedule():
-    schedule.every().day.at(SYNC_TIME).do(sync_runner)
-    while True:
-        schedule.run_pending()
-        time.sleep(1)  # wait one minute
 
+sync_queue.start(do_sync, update_sync_running)
 
-thread = threading.Thread(target = start_schedule)
-thread.start()
+
+scheduler.load_config()
+scheduler.start()
+# Suggestions for the mapping errors page are ready without it waiting for the title index
+title_matcher.warm()
+
+
+def load_dashboard_state() -> dict:
+    """ Fills in any dashboard state that hasn't been set since startup and gets the current state. """
+    if not dashboard_state.is_loaded('num_errors'):
+        dashboard_state.update(num_errors = len(mapping.get_mapping_errors()))
+    if not dashboard_state.is_loaded('recent_updates'):
+        utils.load_recent_updates()
+
+    return dashboard_state.to_dict()
 
 
 @app.route('/')
 def index():
-    num_errors = len(utils.load_json(MAPPING_ERRORS_FILEPATH, {}))
-    num_errors = '' if num_errors == 0 else num_errors
+    state = load_dashboard_state()
+    num_errors = '' if state.get('num_errors') == 0 else state.get('num_errors')
+
+    response = make_response(render_template('index.html', num_errors = num_errors,
+                                             recent_updates = utils.format_recent_updates(state.get('recent_updates')),
+                                             sync_running = str(state.get('sync_running')).lower(),
+                                             next_run = state.get('next_run') or 0))
+    response.set_etag(dashboard_state.etag)
+    return response.make_conditional(request)
+
+
+@app.route('/api/state')
+def state():
+    response = jsonify(load_dashboard_state())
+    response.set_etag(dashboard_state.etag)
+    return response.make_conditional(request)
+
+
+@app.route('/api/schedule')
+def get_schedule():
+    """ Gets the next run of every scheduled sync. """
+    return jsonify({'next_runs': scheduler.next_runs()})
+
+
+@app.route('/api/profiles')
+def list_profiles():
+    return jsonify([x.to_dict() for x in profiles])
+
 
-    recent_updates = "\n".join(utils.get_recent_updates())
+@app.route('/api/logs')
+def logs():
+    """ Gets the buffered log lines after the ?since= cursor so clients can catch up after reconnecting.
 
-    next_run = schedule.jobs[0].next_run
-    time_remaining = (next_run - datetime.now()).total_seconds()
+    ?tail= gets only that many of the latest lines instead.
+    """
+    if 'tail' in request.args:
+        return jsonify(log_buffer.tail(request.args.get('tail', 1, type = int)))
 
-    return render_template('index.html', countdown = utils.get_countdown(), num_errors = num_errors,
-                           recent_updates = recent_updates, sync_running = str(config.sync_running).lower(),
-                           time_remaining = time_remaining, latest_log = config.latest_log)
+    since = request.args.get('since', 0, type = int)
+    limit = request.args.get('limit', 1000, type = int)
+    return jsonify(log_buffer.since(since, limit))
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """ Phase timings and outbound request counts in the Prometheus text format. """
+    return Response(metrics.render(), mimetype = 'text/plain; version=0.0.4')
 
 
 @app.route('/api/driver_screenshot')
 def driver_screenshot():
-    if config.DRIVER is not None:
-        config.DRIVER.save_screenshot()
-        
-    return jsonify({})
+    """ Gets a png screenshot of the browser the sync is using, shared between viewers for SCREENSHOT_INTERVAL_SECONDS. """
+    frame = screenshot_stream.get_frame()
+    if frame is None:
+        return jsonify({'error': 'No browser is running'}), 404
+
+    response = make_response(frame.png)
+    response.headers['Content-Type'] = 'image/png'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(frame.etag)
+    return response.make_conditional(request)
+
+
+@socketio.on('subscribe_screenshots', namespace = '/socket')
+def subscribe_screenshots():
+    """ Sends the client a driver_screenshot event whenever the sync's browser shows something new. """
+    join_room(SCREENSHOT_ROOM)
+    screenshot_stream.subscribe(request.sid)
+
+
+@socketio.on('unsubscribe_screenshots', namespace = '/socket')
+def unsubscribe_screenshots():
+    leave_room(SCREENSHOT_ROOM)
+    screenshot_stream.unsubscribe(request.sid)
+
+
+@socketio.on('disconnect', namespace = '/socket')
+def socket_disconnect():
+    screenshot_stream.unsubscribe(request.sid)
 
 
 @app.route('/mapping_errors', methods = ['GET', 'POST'])
 def mapping_errors():
     if request.method == 'POST':
-        form_data = request.form
-        for k, mal_id in form_data.items():
+        rows = []
+        for k, mal_id in request.form.items():
             mal_id = mal_id.strip()
             if mal_id == '':
                 continue
             tvdbid, season = [x.strip() for x in k.lstrip('formData').split('|')]
-            mapping.add_tvdbid_malid_mapping(tvdbid, season, mal_id)
+            rows.append((tvdbid, season, mal_id))
+
+        mapping.add_tvdbid_malid_mappings(rows)
+
+    errors = mapping.get_mapping_errors()
+    # The anime each unmapped season most likely is, found from the title index without any requests or waiting
+    # for the index to be built
+    suggestions_ready = title_matcher.get_index(block = False) is not None
+    suggestions = {tvdb_id: {season: mapping.get_title_suggestions(data.get('title'), season, block = False)
+                             for season in data.get('unmapped_seasons')}
+                   for tvdb_id, data in errors.items()}
+    return render_template('mappingErrors.html', errors = errors, suggestions = suggestions,
+                           suggestions_ready = suggestions_ready)
 
-    errors = utils.load_json(MAPPING_ERRORS_FILEPATH, {})
-    return render_template('mappingErrors.html', errors = errors)
 
+@app.route('/api/mappings', methods = ['POST'])
+def import_mappings():
+    """ Bulk imports tvdb to mal id mappings from a json or csv body.
 
-@app.route('/api/run_sync')
+    Json bodies are a list of objects with tvdb_id, season and mal_id keys.
+    Csv bodies are rows of tvdb_id,season,mal_id with an optional header row.
+    """
+    if request.is_json:
+        data = request.get_json()
+        if isinstance(data, dict):
+            data = data.get('mappings', [])
+        if not isinstance(data, list) or not all(isinstance(x, dict) for x in data):
+            return jsonify({'error': 'Json bodies must be a list of objects with tvdb_id, season and mal_id keys'}), 400
+        rows = [(x.get('tvdb_id'), x.get('season'), x.get('mal_id')) for x in data]
+    else:
+        upload = request.files.get('file')
+        text = upload.read().decode('utf-8-sig') if upload is not None else request.get_data(as_text = True)
+        rows = [tuple(x.strip() for x in row) for row in csv.reader(io.StringIO(text)) if len(row) > 0]
+        if len(rows) > 0 and rows[0] == CSV_HEADER:
+            rows = rows[1:]
+
+    rejected = mapping.add_tvdbid_malid_mappings(rows)
+    return jsonify({'imported': len(rows) - len(rejected), 'rejected': rejected})
+
+
+@app.route('/api/mappings/export')
+def export_mappings():
+    """ Streams out every tvdb to mal id mapping as csv, or json when ?format=json is given. """
+    if request.args.get('format') == 'json':
+        def generate_json():
+            yield '['
+            for i, (tvdb_id, season, mal_id) in enumerate(mapping.iter_tvdbid_malid_mappings()):
+                row = json.dumps({'tvdb_id': tvdb_id, 'season': season, 'mal_id': mal_id})
+                yield row if i == 0 else ',' + row
+            yield ']'
+
+        return Response(generate_json(), mimetype = 'application/json')
+
+    def generate_csv():
+        yield ','.join(CSV_HEADER) + '\n'
+        for row in mapping.iter_tvdbid_malid_mappings():
+            yield ','.join(row) + '\n'
+
+    return Response(generate_csv(), mimetype = 'text/csv',
+                    headers = {'Content-Disposition': 'attachment; filename=tvdbid_to_malid.csv'})
+
+
+@app.route('/api/run_sync', methods = ['GET', 'POST'])
 def run_sync():
-    sync_runner()
-    return jsonify({})
+    """ Queues a sync and returns straight away with the id of the job that will run it. """
+    job = sync_queue.submit(request.args.get('full', 'false').lower() == 'true')
+    return jsonify(job.to_dict()), 202
+
+
+@app.route('/api/plex_webhook', methods = ['POST'])
+def plex_webhook():
+    """ Receives plex webhook events and queues a sync of the seasons of any watched episodes.
+
+    Plex posts the event as json in the payload field of a multipart form.
+    """
+    if config.WEBHOOK_TOKEN is not None and request.args.get('token') != config.WEBHOOK_TOKEN:
+        return jsonify({'error': 'Invalid token'}), 403
+
+    try:
+        payload = json.loads(request.form.get('payload') or request.get_data(as_text = True))
+    except ValueError:
+        return jsonify({'error': 'Invalid payload'}), 400
+
+    scrobble = parse_scrobble(payload) if isinstance(payload, dict) else None
+    if scrobble is None:
+        return jsonify({'queued': False})
+
+    scrobble_debouncer.add(*scrobble)
+    return jsonify({'queued': True, 'pending': scrobble_debouncer.pending()}), 202
+
+
+@app.route('/api/jobs')
+def list_jobs():
+    return jsonify([x.to_dict() for x in sync_queue.jobs()])
+
+
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    job = sync_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job id'}), 404
+
+    return jsonify(job.to_dict())
+
+
+@app.route('/api/jobs/<job_id>/cancel', methods = ['POST'])
+def cancel_job(job_id):
+    job = sync_queue.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job id'}), 404
+
+    return jsonify(job.to_dict())
 
 
 if __name__ == '__main__':
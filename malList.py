@@ -1,18 +1,126 @@
-import json
+import os
+import time
+from typing import Optional
 
 import requests
-from bs4 import BeautifulSoup
+
+import config
+import utils
+from metrics import InstrumentedSession
+from utils import log
+
+MAL_URL = config.MAL_URL
+PAGE_SIZE = 300
+# Only the fields used by the sync are kept for each entry
+ENTRY_FIELDS = ('status', 'num_watched_episodes', 'anime_num_episodes')
+
+
+class MalListError(Exception):
+    pass
 
 
 class MalList:
-    def __init__(self, username: str):
-        """ Loads the list from myanimelist """
-        url = f'https://myanimelist.net/animelist/{username}?status=7'
-        r = requests.get(url)
-        soup = BeautifulSoup(r.content, 'lxml')
-        data = json.loads(soup.find('table', {'class', 'list-table'}).get('data-items'))
-
-        self.list_data = {str(x.get('anime_id')): x for x in data}
+    def __init__(self, username: str, base_url: str = MAL_URL):
+        """ Loads the list from myanimelist, reusing the copy saved on disk when it hasn't changed.
+
+        :param username: The MyAnimeList user whose list is loaded.
+        :param base_url: The MyAnimeList url, this can be pointed at a local server for testing.
+        """
+        self.username = username
+        self.base_url = base_url.rstrip('/')
+        self.filepath = os.path.join(config.DATA_PATH, f'mal_list_{username}.json')
+
+        cache = utils.load_json(self.filepath) or {}
+        self.list_data = cache.get('entries', {})
+        self.etag = cache.get('etag')
+        self.last_modified = cache.get('last_modified')
+        self.fetched_at = cache.get('fetched_at', 0)
+        # Whether the list has been checked against MyAnimeList since it was created
+        self.refreshed = False
+
+        if len(self.list_data) == 0 or time.time() - self.fetched_at >= config.MAL_LIST_MAX_AGE_HOURS * 3600:
+            try:
+                self.refresh()
+            except MalListError as e:
+                # Without a saved copy every anime would look like it isn't on the list
+                if len(self.list_data) == 0:
+                    raise
+                log(f"{e}, using the saved copy")
+
+    def refresh(self) -> None:
+        """ Pages through the list's json endpoint unless the first page reports the list is unchanged.
+
+        :raises MalListError: If the list couldn't be loaded, the saved copy is left as it was.
+        """
+        log(f"Loading MyAnimeList list for {self.username}")
+        url = f'{self.base_url}/animelist/{self.username}/load.json'
+        headers = {}
+        if len(self.list_data) > 0:
+            if self.etag is not None:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified is not None:
+                headers['If-Modified-Since'] = self.last_modified
+
+        list_data = {}
+        offset = 0
+        with InstrumentedSession('mal') as session:
+            while True:
+                try:
+                    r = session.get(url, params = {'status': 7, 'offset': offset}, timeout = 30,
+                                    headers = headers if offset == 0 else {})
+                except requests.RequestException as e:
+                    raise MalListError(f"Failed to load MyAnimeList list: {e}")
+
+                if r.status_code == 304:
+                    log("MyAnimeList list is unchanged")
+                    self.fetched_at = time.time()
+                    self.refreshed = True
+                    self.save()
+                    return
+
+                if r.status_code != 200:
+                    raise MalListError(f"Failed to load MyAnimeList list: HTTP {r.status_code}")
+
+                if offset == 0:
+                    etag, last_modified = r.headers.get('ETag'), r.headers.get('Last-Modified')
+
+                try:
+                    page = r.json()
+                except ValueError as e:
+                    raise MalListError(f"Failed to load MyAnimeList list: {e}")
+                for entry in page:
+                    list_data[str(entry.get('anime_id'))] = {k: entry.get(k) for k in ENTRY_FIELDS}
+
+                if len(page) < PAGE_SIZE:
+                    break
+                offset += len(page)
+
+        log(f"Loaded {len(list_data)} entries from MyAnimeList")
+        self.list_data = list_data
+        self.etag, self.last_modified = etag, last_modified
+        self.fetched_at = time.time()
+        self.refreshed = True
+        self.save()
+
+    def save(self) -> None:
+        utils.save_json({'entries'      : self.list_data,
+                         'etag'         : self.etag,
+                         'last_modified': self.last_modified,
+                         'fetched_at'   : self.fetched_at}, self.filepath)
+
+    def apply_update(self, mal_id: str, watched_episodes: int, status: str, total_episodes: Optional[int]) -> None:
+        """ Applies an update that was made on MyAnimeList to the local copy of the list.
+
+        :param mal_id: The id of the anime that was updated.
+        :param watched_episodes: The number of watched episodes that was set.
+        :param status: The status that was set.
+        :param total_episodes: The total number of episodes in the anime if known.
+        """
+        entry = self.list_data.setdefault(str(mal_id), {k: None for k in ENTRY_FIELDS})
+        entry['num_watched_episodes'] = watched_episodes
+        entry['status'] = int(status)
+        if total_episodes is not None:
+            entry['anime_num_episodes'] = total_episodes
 
     def get_list_data(self) -> dict:
         return self.list_data
@@ -0,0 +1,68 @@
+import json
+import os
+import time
+
+import config
+
+# A small page that is only shown to logged in users, used to check saved cookies still work
+SESSION_PROBE_PATH = '/panel.php'
+COOKIE_FIELDS = ('name', 'value', 'domain', 'path', 'expiry', 'secure', 'httpOnly')
+
+
+def get_cookie_path(username: str) -> str:
+    return os.path.join(config.DATA_PATH, f'mal_cookies_{username}.json')
+
+
+def load_cookies(username: str) -> list:
+    """ Loads the saved MyAnimeList login cookies for an account.
+
+    :return: List of cookie dictionaries in the selenium format, without any that have expired.
+    """
+    try:
+        with open(get_cookie_path(username), 'r') as f:
+            cookies = json.load(f)
+    except (OSError, ValueError):
+        return []
+
+    now = time.time()
+    return [x for x in cookies if x.get('expiry') is None or x.get('expiry') > now]
+
+
+def save_cookies(username: str, cookies: list) -> None:
+    """ Saves the login cookies of an account so only the owner of the data directory can read them.
+
+    :param cookies: List of cookie dictionaries in the selenium format.
+    """
+    filepath = get_cookie_path(username)
+    temp_filepath = f'{filepath}.tmp'
+    fd = os.open(temp_filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # The mode is only used when the file is created so set it again in case a previous save left the file behind
+    os.chmod(temp_filepath, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump([{k: x.get(k) for k in COOKIE_FIELDS if x.get(k) is not None} for x in cookies], f)
+
+    os.replace(temp_filepath, filepath)
+
+
+def clear_cookies(username: str) -> None:
+    """ Removes saved cookies that no longer log in. """
+    if os.path.exists(get_cookie_path(username)):
+        os.remove(get_cookie_path(username))
+
+
+def export_requests_cookies(jar) -> list:
+    """ Converts the cookies of a requests session to the selenium format they are saved in. """
+    return [{'name'    : x.name,
+             'value'   : x.value,
+             'domain'  : x.domain,
+             'path'    : x.path,
+             'expiry'  : x.expires,
+             'secure'  : x.secure,
+             'httpOnly': x.has_nonstandard_attr('HttpOnly')} for x in jar]
+
+
+def import_requests_cookies(jar, cookies: list) -> None:
+    """ Adds saved cookies to the cookie jar of a requests session. """
+    for x in cookies:
+        jar.set(x.get('name'), x.get('value'), domain = x.get('domain', ''), path = x.get('path', '/'),
+                expires = x.get('expiry'), secure = x.get('secure', False))
@@ -0,0 +1,154 @@
+import re
+from typing import Optional
+
+import requests
+from colorama import Fore
+from requests.adapters import HTTPAdapter
+
+import malSession
+import mapping
+from metrics import InstrumentedSession
+import syncHandler
+import config
+from config import MAL_USERNAME, MAL_PASSWORD
+from utils import log
+
+MAL_URL = config.MAL_URL
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/77.0 Safari/537.36'
+
+
+class MalHttpUpdater:
+    def __init__(self, base_url: str = MAL_URL, username: str = MAL_USERNAME, password: str = MAL_PASSWORD):
+        """ Updates MyAnimeList entries with plain http requests instead of a browser.
+
+        :param base_url: The MyAnimeList url, this can be pointed at a local server for testing.
+        :param username: The MyAnimeList username to log in with.
+        :param password: The MyAnimeList password to log in with.
+        """
+        self.base_url = base_url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.csrf_token = None
+
+        self.session = InstrumentedSession('mal')
+        self.session.headers.update({'User-Agent': USER_AGENT})
+        self.session.mount(self.base_url, HTTPAdapter(pool_connections = 1, pool_maxsize = 4))
+
+    def _update_csrf_token(self, html: str) -> None:
+        match = re.search(r'<meta name=[\'"]csrf_token[\'"] content=[\'"]([^\'"]+)[\'"]', html)
+        if match:
+            self.csrf_token = match.group(1)
+
+    def restore_session(self) -> bool:
+        """ Logs in with the cookies saved by a previous login if they still work.
+
+        :return: True if the saved session is still logged in.
+        """
+        cookies = malSession.load_cookies(self.username)
+        if len(cookies) == 0:
+            return False
+
+        malSession.import_requests_cookies(self.session.cookies, cookies)
+        try:
+            r = self.session.get(f'{self.base_url}{malSession.SESSION_PROBE_PATH}', timeout = 30)
+        except requests.RequestException as e:
+            log(f"Unable to check the saved MyAnimeList session: {e}")
+            return False
+
+        if 'header-profile-link' not in r.text:
+            log("Saved MyAnimeList session has expired")
+            self.session.cookies.clear()
+            malSession.clear_cookies(self.username)
+            return False
+
+        self._update_csrf_token(r.text)
+        log(f"Restored MyAnimeList session for user {self.username}", Fore.GREEN)
+        return True
+
+    def login_myanimelist(self, attempts: int = 1) -> bool:
+        if attempts == 1 and self.restore_session():
+            return True
+
+        if attempts < 5:
+            log(f"Logging into MyAnimeList attempt: {attempts}")
+            try:
+                r = self.session.get(f'{self.base_url}/login.php', timeout = 30)
+                self._update_csrf_token(r.text)
+
+                r = self.session.post(f'{self.base_url}/login.php?from=%2F', timeout = 30,
+                                      data = {'user_name' : self.username,
+                                              'password'  : self.password,
+                                              'cookie'    : 1,
+                                              'sublogin'  : 'Login',
+                                              'submit'    : 1,
+                                              'csrf_token': self.csrf_token})
+            except requests.RequestException as e:
+                log(f"MyAnimeList login request failed: {e}")
+                return self.login_myanimelist(attempts + 1)
+
+            self._update_csrf_token(r.text)
+            if 'header-profile-link' not in r.text:
+                return self.login_myanimelist(attempts + 1)
+
+            log(f"Logged in successfully as user {self.username}", Fore.GREEN)
+            malSession.save_cookies(self.username, malSession.export_requests_cookies(self.session.cookies))
+            return True
+
+        log(f"MyAnimeList login failed")
+        return False
+
+    def get_total_episodes(self, mal_id: str) -> Optional[int]:
+        """ Gets the total episodes of an anime from its MyAnimeList page.
+
+        :return: The number of episodes, None if it is unknown or -1 if the page doesn't exist.
+        """
+        r = self.session.get(f'{self.base_url}/anime/{mal_id}', timeout = 30)
+        if r.status_code == 404:
+            return -1
+
+        self._update_csrf_token(r.text)
+        match = re.search(r'id=[\'"]curEps[\'"][^>]*>\s*(\d+)\s*<', r.text)
+        return int(match.group(1)) if match else None
+
+    def update_series(self, series: dict) -> Optional[str]:
+        log(f"Updating series {series.get('title')} season {series.get('season')}")
+        plex_watched_episodes = series.get('watched_episodes')
+
+        try:
+            total_episodes = series.get('total_episodes')
+            if not series.get('on_list') or not total_episodes:
+                total_episodes = self.get_total_episodes(series.get('mal_id'))
+
+            if total_episodes == -1:
+                log("Error can't load page with that mal id")
+                mapping.add_to_mapping_errors(series.get('tvdb_id'), series.get('title'), str(series.get('season')))
+                return None
+
+            status = syncHandler.get_status(plex_watched_episodes, total_episodes)
+            episodes_seen_value = min(plex_watched_episodes, total_episodes) if total_episodes else plex_watched_episodes
+            payload = {'anime_id'            : int(series.get('mal_id')),
+                       'status'              : int(status),
+                       'num_watched_episodes': episodes_seen_value,
+                       'csrf_token'          : self.csrf_token}
+
+            action = 'edit' if series.get('on_list') else 'add'
+            r = self.session.post(f'{self.base_url}/ownlist/anime/{action}.json', json = payload, timeout = 30)
+
+            # The list shown to us may be out of date so retry with the other action
+            if r.status_code == 400:
+                action = 'add' if action == 'edit' else 'edit'
+                r = self.session.post(f'{self.base_url}/ownlist/anime/{action}.json', json = payload, timeout = 30)
+
+        except requests.RequestException as e:
+            log(f"Failed to update {series.get('title')} season {series.get('season')}: {e}")
+            return None
+
+        if r.status_code != 200:
+            log(f"Failed to update {series.get('title')} season {series.get('season')}: HTTP {r.status_code}")
+            return None
+
+        return status
+
+    def quit(self):
+        """ Close the session. """
+        self.session.close()
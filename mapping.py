@@ -1,46 +1,131 @@
+import gzip
+import http.client
+import shutil
 import xml.etree.ElementTree as et
 import os
-from config import TVDBID_ANIDBID_XML_FILEPATH, TVDBID_ANIDBID_FILEPATH, TVDBID_MALID_FILEPATH, \
-    MAPPING_ERRORS_FILEPATH
+from config import TVDBID_ANIDBID_XML_FILEPATH, TVDBID_ANIDBID_FILEPATH, TVDBID_ANIDBID_META_FILEPATH
+import urllib.error
 import urllib.request
+import config
+import metrics
 import utils
+from anidbResolver import anidb_resolver
+from dashboardState import dashboard_state
+from mappingIndex import mapping_index
+from mappingStore import mapping_store
+from titleIndex import title_matcher
 from utils import log
-from bs4 import BeautifulSoup
 import time
 import urllib.parse
+import zlib
+
+MAPPING_XML_URL = config.MAPPING_XML_URL
+MAPPING_CHECK_INTERVAL = 603_800
 
 
 def get_anidbid(tvdb_id: str, season: str):
-    data = get_tvdb_anidb_mapping().get(tvdb_id) or {}
-    return data.get(season)
+    return mapping_index.get_anidbid(tvdb_id, season)
 
 
 def update_mapping_xml() -> None:
-    if not os.path.exists(TVDBID_ANIDBID_XML_FILEPATH) or not os.path.exists(TVDBID_ANIDBID_FILEPATH):
-        download_tvdb_anidb_mapping()
+    """ Refreshes the tvdb to anidb mapping once the last check is over a week old. """
+    files_exist = os.path.exists(TVDBID_ANIDBID_XML_FILEPATH) and os.path.exists(TVDBID_ANIDBID_FILEPATH)
+    last_checked = (utils.load_json(TVDBID_ANIDBID_META_FILEPATH) or {}).get('checked_at', 0)
 
-    mapping_file_age = time.time() - os.path.getctime(TVDBID_ANIDBID_XML_FILEPATH)
-    if mapping_file_age >= 603_800:
+    if not files_exist or time.time() - last_checked >= MAPPING_CHECK_INTERVAL:
         download_tvdb_anidb_mapping()
 
 
 def download_tvdb_anidb_mapping() -> None:
-    log("Downloading new XML mapping file")
-    if os.path.exists(TVDBID_ANIDBID_XML_FILEPATH):
-        os.remove(TVDBID_ANIDBID_XML_FILEPATH)
+    """ Downloads the anime-list XML mapping if it has changed and converts it to json.
 
-    urllib.request.urlretrieve('https://raw.githubusercontent.com/ScudLee/anime-lists/master/anime-list-full.xml',
-                               TVDBID_ANIDBID_XML_FILEPATH)
+    A conditional request is sent using the validators from the previous download so an unchanged
+    file costs a single 304 response. The existing files are only replaced once the new download
+    has been parsed successfully.
+    """
+    files_exist = os.path.exists(TVDBID_ANIDBID_XML_FILEPATH) and os.path.exists(TVDBID_ANIDBID_FILEPATH)
+    meta = (utils.load_json(TVDBID_ANIDBID_META_FILEPATH) or {}) if files_exist else {}
+
+    headers = {'Accept-Encoding': 'gzip'}
+    if meta.get('etag') is not None:
+        headers['If-None-Match'] = meta.get('etag')
+    if meta.get('last_modified') is not None:
+        headers['If-Modified-Since'] = meta.get('last_modified')
+
+    log("Checking for a new XML mapping file")
+    temp_xml_filepath = f'{TVDBID_ANIDBID_XML_FILEPATH}.tmp'
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(MAPPING_XML_URL, headers = headers), timeout = 60) as response:
+            log("Downloading new XML mapping file")
+            body = gzip.GzipFile(fileobj = response) if response.headers.get('Content-Encoding') == 'gzip' else response
+            with open(temp_xml_filepath, 'wb') as f:
+                shutil.copyfileobj(body, f)
+            # Reads stop early without an error when the connection closes before the whole body has been sent
+            if response.length:
+                raise OSError(f"Connection closed with {response.length} bytes left to download")
+
+            meta = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+            metrics.record_request('github', time.perf_counter() - start, response.status,
+                                   int(response.headers.get('Content-Length') or os.path.getsize(temp_xml_filepath)))
+
+    except urllib.error.HTTPError as e:
+        metrics.record_request('github', time.perf_counter() - start, e.code)
+        if e.code == 304:
+            log("XML mapping file is already up to date")
+            meta['checked_at'] = time.time()
+            utils.save_json(meta, TVDBID_ANIDBID_META_FILEPATH)
+        else:
+            log(f"Failed to download XML mapping file: HTTP {e.code}")
+        return
+
+    # A connection dropped part way through leaves the body or its gzip stream cut short
+    except (urllib.error.URLError, OSError, http.client.HTTPException, EOFError, zlib.error) as e:
+        metrics.record_request('github', time.perf_counter() - start)
+        log(f"Failed to download XML mapping file: {e}")
+        if os.path.exists(temp_xml_filepath):
+            os.remove(temp_xml_filepath)
+        return
 
     log("Parsing new XML data")
-    # Parse the xml into json format for easy access
+    try:
+        with metrics.timed('mapping_parse'):
+            data = parse_tvdb_anidb_mapping(temp_xml_filepath)
+    except et.ParseError as e:
+        log(f"Failed to parse XML mapping file: {e}")
+        os.remove(temp_xml_filepath)
+        return
+
+    # Only swap the files in once everything has succeeded so a failed download keeps the old mapping
+    utils.save_json(data, TVDBID_ANIDBID_FILEPATH)
+    os.replace(temp_xml_filepath, TVDBID_ANIDBID_XML_FILEPATH)
+
+    meta['checked_at'] = time.time()
+    utils.save_json(meta, TVDBID_ANIDBID_META_FILEPATH)
+
+
+def parse_tvdb_anidb_mapping(filepath: str) -> dict:
+    """ Parses the anime-list XML into a tvdb id to anidb id mapping.
+
+    The file is streamed so each anime element is discarded as soon as it has been read.
+
+    :param filepath: Path to the anime-list XML file.
+    :return: Dictionary of tvdb ids to a dictionary of season numbers to anidb ids.
+    """
     data = {}
-    xml_data = et.parse(TVDBID_ANIDBID_XML_FILEPATH).getroot()
-    for anime in list(xml_data):
+    root = None
+    for event, element in et.iterparse(filepath, events = ('start', 'end')):
+        if root is None:
+            root = element
+
+        if event != 'end' or element.tag != 'anime':
+            continue
+
         # Skip all the specials which have a season number of 0
         # Also some seasons are labelled "a" this is for long series like Dragonball skip these too
-        season_number = anime.get('defaulttvdbseason')
-        tvdbid, anidbid = anime.get('tvdbid'), anime.get('anidbid')
+        season_number = element.get('defaulttvdbseason')
+        tvdbid, anidbid = element.get('tvdbid') or '', element.get('anidbid') or ''
+        root.clear()
         if season_number is None or season_number == "0" or not season_number.isdigit() or not tvdbid.isdigit() or not anidbid.isdigit():
             continue
 
@@ -49,116 +134,212 @@ def download_tvdb_anidb_mapping() -> None:
             data[tvdbid] = {}
 
         # Add the anidbid mapping
-        data[tvdbid][int(season_number)] = anidbid
+        data[tvdbid][str(int(season_number))] = anidbid
 
-    utils.save_json(data, TVDBID_ANIDBID_FILEPATH)
+    return data
 
 
 def get_tvdb_anidb_mapping() -> dict:
-    """ Load the tvdb id to anidb id mapping xml file.
+    """ Gets the tvdb id to anidb id mapping from the mapping index.
 
-    :return: xml object containing the mapping data for the tvdb and anidb ids.
+    :return: Dictionary containing the mapping data for the tvdb and anidb ids. This must not be modified.
     """
-
-    return utils.load_json(TVDBID_ANIDBID_FILEPATH, {})
+    return mapping_index.get_tvdb_anidb_mapping()
 
 
 def get_tvdb_mal_mapping() -> dict:
-    return utils.load_json(TVDBID_MALID_FILEPATH, {})
+    """ Gets the tvdb id to mal id mapping from the mapping index.
+
+    :return: Dictionary containing the mapping data for the tvdb and mal ids. This must not be modified.
+    """
+    return mapping_index.get_tvdb_mal_mapping()
 
 
-def obtain_malid(anidb_id: str, driver) -> str:
-    """ Gets the myanimelist id from the anidb page for the anime.
+def get_mapping_errors() -> dict:
+    return mapping_index.get_mapping_errors()
 
-    :param anidb_id: The anidb id for the anime..
-    :return: Returns the myanimelist id as a string.
-    """
-    url = 'https://anidb.net/anime/' + anidb_id
-    soup = BeautifulSoup(driver.get_html(url), 'lxml')
 
-    # Check the two locations for the myanimelist link
-    ele = soup.find('a', {'class': 'i_icon i_resource_mal brand'})
-    if ele is None:
-        ele = soup.find('a', {'class': 'hide mal'})
+def has_mapping_error(tvdb_id: str, season: str) -> bool:
+    return season in (get_mapping_errors().get(tvdb_id) or {}).get('unmapped_seasons', {})
 
-    return ele.get('href').lstrip('https://myanimelist.net/anime/')
+
+def update_error_count() -> None:
+    """ Updates the number of series with mapping errors shown on the dashboard. """
+    dashboard_state.update(num_errors = len(get_mapping_errors()))
 
 
 def add_tvdbid_malid_mapping(tvdb_id: str, season: str, mal_id: str) -> None:
-    mal_id_mapping = get_tvdb_mal_mapping()
-    # Create tvdbid entry if it doesn't already exist
-    if tvdb_id not in mal_id_mapping:
-        mal_id_mapping[tvdb_id] = {}
+    """ Records a tvdb to mal id mapping, resolving any mapping error for the season. """
+    mapping_store.set_malids([(tvdb_id, season, mal_id)])
+    # Inside a larger transaction the index is only changed once the mapping has been committed
+    mapping_store.after_commit(lambda: (mapping_index.set_malid(tvdb_id, season, mal_id), update_error_count()))
+
+
+def add_tvdbid_malid_mappings(rows: list) -> list:
+    """ Records any number of tvdb to mal id mappings in a single transaction.
 
-    mal_id_mapping.get(tvdb_id)[season] = mal_id
+    :param rows: List of (tvdb_id, season, mal_id) tuples.
+    :return: List of the rows that were rejected because they weren't all numeric ids.
+    """
+    valid_rows, rejected_rows = [], []
+    for row in rows:
+        row = tuple(str(x).strip() for x in row)
+        if len(row) == 3 and all(x.isdigit() for x in row):
+            valid_rows.append((row[0], str(int(row[1])), row[2]))
+        else:
+            rejected_rows.append(row)
+
+    log(f"Importing {len(valid_rows)} mappings")
+    mapping_store.set_malids(valid_rows)
+    for tvdb_id, season, mal_id in valid_rows:
+        mapping_index.set_malid(tvdb_id, season, mal_id)
 
-    utils.save_json(mal_id_mapping, TVDBID_MALID_FILEPATH)
     verify_mapping_errors()
+    return rejected_rows
+
+
+def iter_tvdbid_malid_mappings():
+    """ Iterates over every tvdb to mal id mapping.
+
+    :return: Generator of (tvdb_id, season, mal_id) tuples.
+    """
+    for tvdb_id, seasons in list(get_tvdb_mal_mapping().items()):
+        for season, mal_id in list(seasons.items()):
+            yield tvdb_id, season, mal_id
 
 
 def add_to_mapping_errors(tvdb_id: str, title: str, season: str) -> None:
-    error_log = utils.load_json(MAPPING_ERRORS_FILEPATH, {})
+    """ Records a season that couldn't be mapped so the user can manually correct it. """
+    prop = urllib.parse.quote_plus(f"{title} season {season}")
+    search_url = f'https://myanimelist.net/search/all?q={prop}'
 
-    if tvdb_id not in error_log:
-        error_log[tvdb_id] = {'title': title, 'unmapped_seasons': {}}
+    if mapping_store.add_mapping_error(tvdb_id, title, season, search_url):
+        mapping_store.after_commit(lambda: (mapping_index.add_mapping_error(tvdb_id, title, season, search_url),
+                                            update_error_count()))
 
-    if season not in error_log.get(tvdb_id).get('unmapped_seasons'):
-        prop = urllib.parse.quote_plus(f"{title} season {season}")
-        search_url = f'https://myanimelist.net/search/all?q={prop}'
-        error_log.get(tvdb_id).get('unmapped_seasons')[season] = search_url
 
-    utils.save_json(error_log, MAPPING_ERRORS_FILEPATH)
-    verify_mapping_errors()
+def get_title_suggestions(title: str, season: str, limit: int = 3, resolve: bool = False, block: bool = True) -> list:
+    """ Finds the anime an unmapped season is most likely to be by its title.
+
+    :param limit: The maximum number of suggestions.
+    :param resolve: Whether to fetch the anidb pages of suggestions whose mal id isn't known yet,
+                    otherwise only the cached mal ids are used.
+    :param block: Whether to wait for the title index to be built, otherwise there are no suggestions until it is.
+    :return: List of dictionaries with the anidb_id, mal_id, title and score of each suggestion, best first.
+    """
+    suggestions = title_matcher.search(title, int(season), limit, block)
+    unknown = [x.get('anidb_id') for x in suggestions if x.get('mal_id') is None and x.get('anidb_id') is not None]
+    if resolve:
+        mal_ids = anidb_resolver.resolve(unknown) if len(unknown) > 0 else {}
+    else:
+        mal_ids = {x: (anidb_resolver.get_cached(x) or {}).get('mal_id') for x in unknown}
+
+    for suggestion in suggestions:
+        if suggestion.get('mal_id') is None:
+            suggestion['mal_id'] = mal_ids.get(suggestion.get('anidb_id'))
+
+    return suggestions
+
+
+def match_titles(seasons: list) -> dict:
+    """ Finds the mal ids of unmapped seasons whose title matches an anime well enough to map automatically.
+
+    The best suggestion is only used when it scores at least TITLE_MATCH_AUTO_APPLY_SCORE, no other anime
+    scores as well and neither its mal id nor its anidb id is already mapped to another season.
+
+    :param seasons: List of (title, tvdb id, season number) tuples.
+    :return: Dictionary of (tvdb id, season number) tuples to the matched mal id.
+    """
+    matches = {}
+    if len(seasons) == 0 or config.TITLE_MATCH_AUTO_APPLY_SCORE > 1:
+        return matches
+
+    for title, tvdbid, season in seasons:
+        suggestions = [x for x in get_title_suggestions(title, season, resolve = True) if x.get('mal_id') is not None]
+        confident = [x for x in suggestions if x.get('score') >= config.TITLE_MATCH_AUTO_APPLY_SCORE]
+        if len({x.get('mal_id') for x in confident}) != 1:
+            continue
+
+        best = confident[0]
+        mapped_to = mapping_index.get_tvdbid_for_malid(best.get('mal_id'))
+        anidb_mapped_to = mapping_index.get_tvdbid_for_anidbid(best.get('anidb_id'))
+        if mapped_to not in (None, (tvdbid, season)) or anidb_mapped_to not in (None, (tvdbid, season)):
+            continue
+
+        log(f"Matched {title} season {season} to {best.get('title')} ({best.get('mal_id')}) by its title")
+        matches[(tvdbid, season)] = best.get('mal_id')
+
+    return matches
+
 
+def update_tvdb_mal_mappings(shows: list) -> int:
+    """ Finds the mal ids for every unmapped season of the given shows.
 
-def update_tvdb_mal_mapping(title: str, tvdbid: str, seasons: list, driver) -> None:
-    tvdb_mal_mapping = get_tvdb_mal_mapping()
-    log(f"Checking mappings for {title}")
-    # Check if series is mapped at all
-    if tvdbid not in tvdb_mal_mapping:
-        tvdb_mal_mapping[tvdbid] = {}
+    The mal ids are resolved from anidb concurrently and all the changes are written in one transaction.
 
-    series_mapping = tvdb_mal_mapping.get(tvdbid)
-    for season in seasons:
-        log(f"{title} season {season}")
-        mal_id = series_mapping.get(season)
+    Seasons that can't be mapped through anidb are matched by title where the match is good enough.
+
+    :param shows: List of (title, tvdb id, list of season numbers) tuples.
+    :return: The number of seasons that were newly mapped.
+    """
+    unmapped_seasons = []
+    anidb_seasons = []
+    for title, tvdbid, seasons in shows:
+        log(f"Checking mappings for {title}")
+        for season in seasons:
+            # Already mapped
+            if mapping_index.get_malid(tvdbid, season) is not None:
+                continue
 
-        # Failed to get mal_id from mapping
-        if mal_id is None:
             # Get the anidb_id and obtain the mal_id from that
-            log(f"Getting mal id for {title} season {season}")
             anidb_id = get_anidbid(tvdbid, season)
 
             # Failed to find the matching anidb_id
             if anidb_id is None:
-                # Add the information to the error log so the user can manually correct it
-                print("Unable to find anidb id so this will need to be added manually")
-                add_to_mapping_errors(tvdbid, title, season)
+                log(f"Unable to find anidb id for {title} season {season}")
+                unmapped_seasons.append((title, tvdbid, season))
                 continue
 
-            mal_id = obtain_malid(anidb_id, driver)
-            add_tvdbid_malid_mapping(tvdbid, season, mal_id)
+            anidb_seasons.append((title, tvdbid, season, anidb_id))
 
+    mal_ids = anidb_resolver.resolve([x[3] for x in anidb_seasons])
+    resolved = 0
 
-def verify_mapping_errors():
-    log("Verifying mapping errors")
-    mapping_errors = utils.load_json(MAPPING_ERRORS_FILEPATH, {})
-    tvdb_mal_mapping = get_tvdb_mal_mapping()
+    # The anidb page has no MyAnimeList link
+    unmapped_seasons.extend((title, tvdbid, season) for title, tvdbid, season, anidb_id in anidb_seasons
+                            if anidb_id in mal_ids and mal_ids.get(anidb_id) is None)
+    title_matches = match_titles(unmapped_seasons)
 
-    for tvdbid, data in list(mapping_errors.items()):
-        if tvdbid not in tvdb_mal_mapping:
-            continue
+    with mapping_store.transaction():
+        for title, tvdbid, season, anidb_id in anidb_seasons:
+            # The anidb page couldn't be loaded so try again next sync
+            if anidb_id not in mal_ids:
+                continue
 
-        series_mapping = tvdb_mal_mapping.get(tvdbid)
-        title = data.get('title')
-        for season in list(data.get('unmapped_seasons').keys()):
-            if series_mapping.get(season) is not None:
-                log(f"{title} Season {season} has been mapped. Removing from errors")
-                mapping_errors.get(tvdbid).get('unmapped_seasons').pop(season)
+            mal_id = mal_ids.get(anidb_id)
+            if mal_id is not None:
+                add_tvdbid_malid_mapping(tvdbid, season, mal_id)
+                resolved += 1
 
-        if len(mapping_errors.get(tvdbid).get('unmapped_seasons')) == 0:
-            log(f"{title} no longer has any unmapped seasons. Removing from errors")
-            del mapping_errors[tvdbid]
+        for title, tvdbid, season in unmapped_seasons:
+            mal_id = title_matches.get((tvdbid, season))
+            if mal_id is not None:
+                add_tvdbid_malid_mapping(tvdbid, season, mal_id)
+                resolved += 1
+                continue
+
+            # Add the information to the error log so the user can manually correct it
+            log(f"Unable to find mal id for {title} season {season} so this will need to be added manually")
+            add_to_mapping_errors(tvdbid, title, season)
+
+    return resolved
+
+
+def verify_mapping_errors():
+    log("Verifying mapping errors")
+    for tvdbid, season, title in mapping_store.remove_mapped_errors():
+        log(f"{title} Season {season} has been mapped. Removing from errors")
+        mapping_index.remove_mapping_error(tvdbid, season)
 
-    utils.save_json(mapping_errors, MAPPING_ERRORS_FILEPATH)
+    update_error_count()
     log("Mapping errors verified")
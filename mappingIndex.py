@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+from typing import Optional, Tuple
+
+import utils
+from config import TVDBID_ANIDBID_FILEPATH
+from mappingStore import mapping_store
+
+# How long to trust the cached data before checking the file modification times again
+STAT_INTERVAL = 5
+
+
+class MappingIndex:
+    def __init__(self):
+        """ Process-wide in-memory index of the mappings.
+
+        The anidb mapping file is loaded once and only reloaded when its modification time changes.
+        The mal id mappings and mapping errors are loaded once from the mapping store and then kept in
+        step with it by the mapping module.
+        """
+        self._lock = threading.RLock()
+        self._load_lock = threading.Lock()
+        self._mtimes = {}
+        self._last_stat = {}
+        self._store_loaded = False
+
+        self.tvdb_to_anidb = {}
+        self.anidb_to_tvdb = {}
+        self.tvdb_to_mal = {}
+        self.mal_to_tvdb = {}
+        self.mapping_errors = {}
+
+    def _is_stale(self, filepath: str) -> bool:
+        """ Checks whether a file has changed since it was last loaded.
+
+        :param filepath: The path of the mapping file.
+        :return: True if the file needs to be reloaded.
+        """
+        now = time.time()
+        if filepath in self._mtimes and now - self._last_stat.get(filepath, 0) < STAT_INTERVAL:
+            return False
+
+        self._last_stat[filepath] = now
+        mtime = os.path.getmtime(filepath) if os.path.exists(filepath) else None
+        return filepath not in self._mtimes or self._mtimes.get(filepath) != mtime
+
+    def _mark_current(self, filepath: str) -> None:
+        """ Records the modification time of a file as the one matching the in-memory data.
+
+        :param filepath: The path of the mapping file that is being loaded.
+        """
+        self._mtimes[filepath] = os.path.getmtime(filepath) if os.path.exists(filepath) else None
+        self._last_stat[filepath] = time.time()
+
+    def _refresh_anidb(self) -> None:
+        with self._lock:
+            if not self._is_stale(TVDBID_ANIDBID_FILEPATH):
+                return
+
+            self._mark_current(TVDBID_ANIDBID_FILEPATH)
+            self.tvdb_to_anidb = utils.load_json(TVDBID_ANIDBID_FILEPATH) or {}
+            self.anidb_to_tvdb = {anidb_id: (tvdb_id, season)
+                                  for tvdb_id, seasons in self.tvdb_to_anidb.items()
+                                  for season, anidb_id in seasons.items()}
+
+    def _refresh_store(self) -> None:
+        if self._store_loaded:
+            return
+
+        # The store is only called without holding the index lock so the two locks are never taken in opposite
+        # orders, changes to the store are applied to the index after they commit
+        with self._load_lock:
+            if self._store_loaded:
+                return
+
+            mapping_store.migrate_json_files()
+            tvdb_to_mal = mapping_store.get_tvdb_mal_mapping()
+            mapping_errors = mapping_store.get_mapping_errors()
+
+            with self._lock:
+                self.tvdb_to_mal = tvdb_to_mal
+                self.mal_to_tvdb = {mal_id: (tvdb_id, season)
+                                    for tvdb_id, seasons in tvdb_to_mal.items()
+                                    for season, mal_id in seasons.items()}
+                self.mapping_errors = mapping_errors
+                self._store_loaded = True
+
+    def get_anidbid(self, tvdb_id: str, season: str) -> Optional[str]:
+        self._refresh_anidb()
+        return (self.tvdb_to_anidb.get(tvdb_id) or {}).get(season)
+
+    def get_tvdbid_for_anidbid(self, anidb_id: str) -> Optional[Tuple[str, str]]:
+        """ Reverse lookup of an anidb id.
+
+        :return: Tuple of the tvdb id and season number or None if the anidb id isn't mapped.
+        """
+        self._refresh_anidb()
+        return self.anidb_to_tvdb.get(anidb_id)
+
+    def get_tvdb_anidb_mapping(self) -> dict:
+        self._refresh_anidb()
+        return self.tvdb_to_anidb
+
+    def get_malid(self, tvdb_id: str, season: str) -> Optional[str]:
+        self._refresh_store()
+        return (self.tvdb_to_mal.get(tvdb_id) or {}).get(season)
+
+    def get_series_mapping(self, tvdb_id: str) -> Optional[dict]:
+        self._refresh_store()
+        return self.tvdb_to_mal.get(tvdb_id)
+
+    def get_tvdbid_for_malid(self, mal_id: str) -> Optional[Tuple[str, str]]:
+        """ Reverse lookup of a myanimelist id.
+
+        :return: Tuple of the tvdb id and season number or None if the mal id isn't mapped.
+        """
+        self._refresh_store()
+        return self.mal_to_tvdb.get(mal_id)
+
+    def get_tvdb_mal_mapping(self) -> dict:
+        self._refresh_store()
+        return self.tvdb_to_mal
+
+    def set_malid(self, tvdb_id: str, season: str, mal_id: str) -> None:
+        """ Updates the tvdb to mal id mapping and its reverse index in memory. """
+        self._refresh_store()
+        with self._lock:
+            series_mapping = self.tvdb_to_mal.setdefault(tvdb_id, {})
+            previous_mal_id = series_mapping.get(season)
+            if previous_mal_id is not None and self.mal_to_tvdb.get(previous_mal_id) == (tvdb_id, season):
+                del self.mal_to_tvdb[previous_mal_id]
+
+            series_mapping[season] = mal_id
+            self.mal_to_tvdb[mal_id] = (tvdb_id, season)
+            self.remove_mapping_error(tvdb_id, season)
+
+    def get_mapping_errors(self) -> dict:
+        self._refresh_store()
+        return self.mapping_errors
+
+    def add_mapping_error(self, tvdb_id: str, title: str, season: str, search_url: str) -> None:
+        self._refresh_store()
+        with self._lock:
+            series_errors = self.mapping_errors.setdefault(tvdb_id, {'title': title, 'unmapped_seasons': {}})
+            series_errors.get('unmapped_seasons')[season] = search_url
+
+    def remove_mapping_error(self, tvdb_id: str, season: str) -> None:
+        self._refresh_store()
+        with self._lock:
+            series_errors = self.mapping_errors.get(tvdb_id)
+            if series_errors is None:
+                return
+
+            series_errors.get('unmapped_seasons').pop(season, None)
+            if len(series_errors.get('unmapped_seasons')) == 0:
+                del self.mapping_errors[tvdb_id]
+
+
+mapping_index = MappingIndex()
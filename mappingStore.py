@@ -0,0 +1,172 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterable, List, Tuple
+
+import utils
+from config import MAPPING_DB_FILEPATH, TVDBID_MALID_FILEPATH, MAPPING_ERRORS_FILEPATH
+from utils import log
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tvdb_mal (
+    tvdb_id TEXT NOT NULL,
+    season  TEXT NOT NULL,
+    mal_id  TEXT NOT NULL,
+    PRIMARY KEY (tvdb_id, season)
+);
+CREATE INDEX IF NOT EXISTS tvdb_mal_mal_id ON tvdb_mal (mal_id);
+
+CREATE TABLE IF NOT EXISTS mapping_errors (
+    tvdb_id    TEXT NOT NULL,
+    season     TEXT NOT NULL,
+    title      TEXT NOT NULL,
+    search_url TEXT NOT NULL,
+    PRIMARY KEY (tvdb_id, season)
+);
+"""
+
+
+class MappingStore:
+    def __init__(self, filepath: str):
+        """ SQLite backed storage for the tvdb to mal id mappings and the mapping errors.
+
+        :param filepath: Path to the SQLite database file.
+        """
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._after_commit = []
+        # Transactions are managed manually so that several writes can be batched together
+        self._conn = sqlite3.connect(filepath, check_same_thread = False, isolation_level = None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        """ Groups all writes made inside the block into a single transaction.
+
+        Transactions can be nested, only the outermost block commits. Callbacks added with after_commit are
+        run once it has committed and after the store's lock is released, or dropped if it is rolled back.
+        """
+        callbacks = []
+        with self._lock:
+            if self._depth == 0:
+                self._conn.execute('BEGIN IMMEDIATE')
+
+            self._depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._conn.execute('ROLLBACK')
+                    self._after_commit = []
+                raise
+
+            self._depth -= 1
+            if self._depth == 0:
+                self._conn.execute('COMMIT')
+                callbacks, self._after_commit = self._after_commit, []
+
+        for callback in callbacks:
+            callback()
+
+    def after_commit(self, callback) -> None:
+        """ Runs a function once the current transaction commits, or straight away outside of a transaction.
+
+        This keeps copies of the data held elsewhere from changing when the transaction is rolled back.
+        """
+        with self._lock:
+            if self._depth > 0:
+                self._after_commit.append(callback)
+                return
+
+        callback()
+
+    def set_malids(self, rows: Iterable[Tuple[str, str, str]]) -> None:
+        """ Upserts tvdb to mal id mappings and clears any mapping errors they resolve.
+
+        :param rows: Iterable of (tvdb_id, season, mal_id) tuples.
+        """
+        rows = list(rows)
+        with self.transaction():
+            self._conn.executemany('INSERT OR REPLACE INTO tvdb_mal (tvdb_id, season, mal_id) VALUES (?, ?, ?)', rows)
+            self._conn.executemany('DELETE FROM mapping_errors WHERE tvdb_id = ? AND season = ?',
+                                   [(tvdb_id, season) for tvdb_id, season, _ in rows])
+
+    def get_tvdb_mal_mapping(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute('SELECT tvdb_id, season, mal_id FROM tvdb_mal').fetchall()
+
+        data = {}
+        for tvdb_id, season, mal_id in rows:
+            data.setdefault(tvdb_id, {})[season] = mal_id
+
+        return data
+
+    def add_mapping_error(self, tvdb_id: str, title: str, season: str, search_url: str) -> bool:
+        """ Records a season that could not be mapped unless it is already mapped or recorded.
+
+        :return: True if a new error was recorded.
+        """
+        with self.transaction():
+            cursor = self._conn.execute(
+                'INSERT OR IGNORE INTO mapping_errors (tvdb_id, season, title, search_url) '
+                'SELECT ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM tvdb_mal WHERE tvdb_id = ? AND season = ?)',
+                (tvdb_id, season, title, search_url, tvdb_id, season))
+
+        return cursor.rowcount > 0
+
+    def get_mapping_errors(self) -> dict:
+        """ Gets the mapping errors grouped by series.
+
+        :return: Dictionary of tvdb ids to the series title and its unmapped seasons with their search urls.
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT tvdb_id, season, title, search_url FROM mapping_errors').fetchall()
+
+        errors = {}
+        for tvdb_id, season, title, search_url in rows:
+            errors.setdefault(tvdb_id, {'title': title, 'unmapped_seasons': {}})['unmapped_seasons'][season] = search_url
+
+        return errors
+
+    def remove_mapped_errors(self) -> List[Tuple[str, str, str]]:
+        """ Deletes all mapping errors for seasons that now have a mapping.
+
+        :return: List of (tvdb_id, season, title) tuples that were removed.
+        """
+        with self.transaction():
+            removed = self._conn.execute(
+                'SELECT e.tvdb_id, e.season, e.title FROM mapping_errors e '
+                'JOIN tvdb_mal m ON m.tvdb_id = e.tvdb_id AND m.season = e.season').fetchall()
+            self._conn.executemany('DELETE FROM mapping_errors WHERE tvdb_id = ? AND season = ?',
+                                   [(tvdb_id, season) for tvdb_id, season, _ in removed])
+
+        return removed
+
+    def migrate_json_files(self) -> None:
+        """ One-time import of the legacy json mapping files.
+
+        The files are renamed once imported so the migration never runs twice.
+        """
+        if os.path.exists(TVDBID_MALID_FILEPATH):
+            log("Migrating tvdb to mal id mappings to the database")
+            mal_mapping = utils.load_json(TVDBID_MALID_FILEPATH) or {}
+            self.set_malids((tvdb_id, str(season), str(mal_id))
+                            for tvdb_id, seasons in mal_mapping.items()
+                            for season, mal_id in seasons.items())
+            os.replace(TVDBID_MALID_FILEPATH, f'{TVDBID_MALID_FILEPATH}.migrated')
+
+        if os.path.exists(MAPPING_ERRORS_FILEPATH):
+            log("Migrating mapping errors to the database")
+            mapping_errors = utils.load_json(MAPPING_ERRORS_FILEPATH) or {}
+            with self.transaction():
+                for tvdb_id, data in mapping_errors.items():
+                    for season, search_url in data.get('unmapped_seasons').items():
+                        self.add_mapping_error(tvdb_id, data.get('title'), str(season), search_url)
+            os.replace(MAPPING_ERRORS_FILEPATH, f'{MAPPING_ERRORS_FILEPATH}.migrated')
+
+
+mapping_store = MappingStore(MAPPING_DB_FILEPATH)
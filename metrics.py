@@ -0,0 +1,138 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import requests
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    labels = [f'{k}="{escape_label(v)}"' for k, v in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if len(labels) > 0 else ''
+
+
+class Counter:
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        """ Prometheus counter that is broken down by a set of labels. """
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        """ Prometheus histogram that is broken down by a set of labels. """
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # Label values to [bucket counts, sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values) -> None:
+        with self._lock:
+            data = self._values.setdefault(label_values, [[0] * len(self.buckets), 0, 0])
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                data[0][index] += 1
+            data[1] += value
+            data[2] += 1
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for label_values, (bucket_counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labels, label_values, f'le="{bound}"')
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+
+                labels = _format_labels(self.labels, label_values, 'le="+Inf"')
+                lines.append(f'{self.name}_bucket{labels} {count}')
+                lines.append(f'{self.name}_sum{_format_labels(self.labels, label_values)} {total}')
+                lines.append(f'{self.name}_count{_format_labels(self.labels, label_values)} {count}')
+        return lines
+
+
+PHASE_SECONDS = Histogram('plex_mal_sync_phase_seconds', 'Time spent in each phase of a sync.', ('phase',))
+PHASE_ERRORS = Counter('plex_mal_sync_phase_errors_total', 'Phases that ended with an exception.', ('phase',))
+REQUEST_SECONDS = Histogram('plex_mal_sync_request_seconds', 'Duration of outbound http requests.', ('service',))
+REQUESTS = Counter('plex_mal_sync_requests_total', 'Outbound http requests by response status.',
+                   ('service', 'status'))
+RESPONSE_BYTES = Counter('plex_mal_sync_response_bytes_total', 'Bytes received from outbound http requests.',
+                         ('service',))
+REQUEST_ERRORS = Counter('plex_mal_sync_request_errors_total',
+                         'Outbound http requests that failed or returned an error status.', ('service',))
+ALL_METRICS = (PHASE_SECONDS, PHASE_ERRORS, REQUEST_SECONDS, REQUESTS, RESPONSE_BYTES, REQUEST_ERRORS)
+
+
+@contextmanager
+def timed(phase: str):
+    """ Records how long the block takes in the phase histogram. """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        PHASE_ERRORS.inc(phase)
+        raise
+    finally:
+        PHASE_SECONDS.observe(time.perf_counter() - start, phase)
+
+
+def record_request(service: str, seconds: float, status: int = None, num_bytes: int = 0) -> None:
+    """ Records an outbound request, a status of None means the request failed before a response. """
+    REQUEST_SECONDS.observe(seconds, service)
+    REQUESTS.inc(service, str(status) if status is not None else 'error')
+    RESPONSE_BYTES.inc(service, amount = num_bytes)
+    if status is None or status >= 400:
+        REQUEST_ERRORS.inc(service)
+
+
+class InstrumentedSession(requests.Session):
+    def __init__(self, service: str):
+        """ requests session that records every request it makes under a service name. """
+        super().__init__()
+        self.service = service
+
+    def request(self, method, url, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except requests.RequestException:
+            record_request(self.service, time.perf_counter() - start)
+            raise
+
+        num_bytes = len(response.content) if not kwargs.get('stream') else 0
+        record_request(self.service, time.perf_counter() - start, response.status_code, num_bytes)
+        return response
+
+
+def render() -> str:
+    """ Renders every metric in the Prometheus text format. """
+    lines = []
+    for metric in ALL_METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -1,7 +1,61 @@
-from typing import Optional
+import re
+from typing import Optional, Iterator
+from xml.etree.ElementTree import Element
+
+from metrics import InstrumentedSession
 from utils import log
+from plexapi.exceptions import BadRequest, NotFound
 from plexapi.server import PlexServer
 
+PAGE_SIZE = 200
+
+
+class ShowRecord:
+    __slots__ = ('rating_key', 'title', 'tvdb_id', 'seasons')
+
+    def __init__(self, rating_key: int, title: str, tvdb_id: str):
+        """ Compact record of a show in the library snapshot.
+
+        :param rating_key: The plex rating key of the show.
+        :param title: The title of the show.
+        :param tvdb_id: The tvdb id taken from the show's guid.
+        """
+        self.rating_key = rating_key
+        self.title = title
+        self.tvdb_id = tvdb_id
+        # Season numbers to (episode count, watched episode count) tuples
+        self.seasons = {}
+
+
+class LibrarySnapshot:
+    __slots__ = ('shows', 'watermark', 'full')
+
+    def __init__(self, shows: list, watermark: int, full: bool):
+        """ The shows loaded from a library for a single sync.
+
+        :param shows: List of ShowRecord objects.
+        :param watermark: The latest lastViewedAt or updatedAt timestamp seen while loading.
+        :param full: Whether every show in the library was loaded or only the changed ones.
+        """
+        self.shows = shows
+        self.watermark = watermark
+        self.full = full
+
+
+def get_watermark(element: Element, watermark: int) -> int:
+    """ Gets the latest change timestamp out of the current watermark and an element's timestamps. """
+    return max([watermark] + [int(element.attrib.get(x)) for x in ('lastViewedAt', 'updatedAt')
+                              if element.attrib.get(x, '').isdigit()])
+
+
+def get_tvdb_id(guid: str) -> Optional[str]:
+    """ Gets the tvdb id from a plex guid such as com.plexapp.agents.thetvdb://12345?lang=en
+
+    :return: The tvdb id or None if the show isn't matched with the tvdb agent.
+    """
+    match = re.search(r'thetvdb://(\d+)', guid or '')
+    return match.group(1) if match else None
+
 
 class PlexConnection(PlexServer):
     def __init__(self, server_url: str, server_token: str) -> None:
@@ -11,17 +65,127 @@ class PlexConnection(PlexServer):
         :param server_token: The token for the target server.
         """
         log("Connecting to plex server")
-        super().__init__(server_url, server_token)
+        super().__init__(server_url, server_token, session = InstrumentedSession('plex'))
         log("Plex connection established")
 
-    def get_shows(self, library: str) -> Optional[list]:
-        """ Gets all the shows in a given library.
+    def iter_container(self, key: str, page_size: int = PAGE_SIZE) -> Iterator[Element]:
+        """ Pages through a library container so only one page is held in memory at a time.
+
+        :param key: The container key including any query arguments.
+        :param page_size: The number of items requested per page.
+        :return: Generator of the raw xml elements in the container.
+        """
+        separator = '&' if '?' in key else '?'
+        start = 0
+        while True:
+            container = self.query(f'{key}{separator}X-Plex-Container-Start={start}&X-Plex-Container-Size={page_size}')
+            items = list(container) if container is not None else []
+            yield from items
+
+            if len(items) < page_size:
+                return
+            start += page_size
+
+    def get_library_snapshot(self, library: str, since: Optional[int] = None) -> Optional[LibrarySnapshot]:
+        """ Builds a compact snapshot of the shows in a library and their season episode counts.
 
         :param library: The name of the target library.
-        :return: A list of Show objects from the target library.
+        :param since: Only load shows with episodes watched at or after this timestamp. Loads every show when None.
+        :return: A LibrarySnapshot or None if the library doesn't exist.
         """
         log(f"Getting shows for library {library}")
-        if library in [x.title for x in self.library.sections()]:
-            return self.library.section(library).all()
+        sections = {x.title: x for x in self.library.sections()}
+        if library not in sections:
+            return None
+
+        key = f'/library/sections/{sections.get(library).key}/all'
+        if since is None:
+            shows, watermark = self._load_all_shows(key)
+        else:
+            shows, watermark = self._load_changed_shows(key, since)
+
+        log(f"Found {len(shows)} {'shows' if since is None else 'changed shows'} in library {library}")
+        return LibrarySnapshot(list(shows.values()), watermark, since is None)
+
+    def get_shows_snapshot(self, library: str, targets: dict) -> LibrarySnapshot:
+        """ Builds a snapshot of only the given seasons of the given shows.
+
+        :param library: The name of the library the shows must be in.
+        :param targets: Dictionary of show rating keys to sets of season numbers.
+        :return: A LibrarySnapshot of the shows that were found.
+        """
+        shows, watermark = self._load_shows_by_key(targets, 0, library)
+        for show in shows.values():
+            show.seasons = {k: v for k, v in show.seasons.items() if k in targets.get(show.rating_key)}
+
+        log(f"Found {len(shows)} of {len(targets)} targeted shows in library {library}")
+        return LibrarySnapshot(list(shows.values()), watermark, False)
+
+    def _add_show(self, shows: dict, show: Element) -> None:
+        tvdb_id = get_tvdb_id(show.attrib.get('guid'))
+        if tvdb_id is None:
+            log(f"Skipping {show.attrib.get('title')} as it isn't matched with the tvdb agent")
+            return
+
+        rating_key = int(show.attrib.get('ratingKey'))
+        shows[rating_key] = ShowRecord(rating_key, show.attrib.get('title'), tvdb_id)
+
+    def _add_seasons(self, shows: dict, seasons: Iterator[Element], watermark: int) -> int:
+        """ Adds the episode counts of seasons to their shows.
+
+        :return: The watermark updated with the timestamps of the seasons.
+        """
+        for season in seasons:
+            show = shows.get(int(season.attrib.get('parentRatingKey', 0)))
+            season_number = season.attrib.get('index')
+            if show is None or season_number is None:
+                continue
+
+            show.seasons[int(season_number)] = (int(season.attrib.get('leafCount', 0)),
+                                                int(season.attrib.get('viewedLeafCount', 0)))
+            watermark = get_watermark(season, watermark)
+
+        return watermark
+
+    def _load_all_shows(self, key: str) -> tuple:
+        # Shows are type 2
+        shows = {}
+        for show in self.iter_container(f'{key}?type=2'):
+            self._add_show(shows, show)
+
+        # Seasons are type 3 and carry the episode and watched episode counts
+        watermark = self._add_seasons(shows, self.iter_container(f'{key}?type=3'), 0)
+        return shows, watermark
+
+    def _load_changed_shows(self, key: str, since: int) -> tuple:
+        # Episodes are type 4, find the shows of any episodes watched since the last sync
+        changed_keys = set()
+        watermark = since
+        for episode in self.iter_container(f'{key}?type=4&lastViewedAt>>={since}'):
+            changed_keys.add(int(episode.attrib.get('grandparentRatingKey')))
+            watermark = get_watermark(episode, watermark)
+
+        return self._load_shows_by_key(changed_keys, watermark)
+
+    def _load_shows_by_key(self, rating_keys, watermark: int, library: Optional[str] = None) -> tuple:
+        """ Loads shows and their seasons one at a time by rating key.
+
+        :param library: Skip shows that aren't in this library when given.
+        """
+        shows = {}
+        for rating_key in rating_keys:
+            try:
+                container = self.query(f'/library/metadata/{rating_key}')
+            except (BadRequest, NotFound):
+                log(f"Skipping show {rating_key} as it is no longer on the plex server")
+                continue
+
+            for show in container if container is not None else []:
+                section = show.attrib.get('librarySectionTitle', container.attrib.get('librarySectionTitle'))
+                if library is None or section == library:
+                    self._add_show(shows, show)
+
+            if int(rating_key) in shows:
+                watermark = self._add_seasons(shows, self.query(f'/library/metadata/{rating_key}/children'), watermark)
 
-        return None
+        return shows, watermark
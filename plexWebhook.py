@@ -0,0 +1,83 @@
+import threading
+import time
+from typing import Optional
+
+import config
+from syncJobs import sync_queue
+from utils import log
+
+
+def parse_scrobble(payload: dict) -> Optional[tuple]:
+    """ Gets the show and season of a plex webhook payload for a watched episode.
+
+    :param payload: The json payload plex sends with every webhook event.
+    :return: Tuple of the show's rating key, the season number and the show title, or None for any other event.
+    """
+    metadata = payload.get('Metadata') or {}
+    if payload.get('event') != 'media.scrobble' or metadata.get('type') != 'episode':
+        return None
+
+    rating_key, season = metadata.get('grandparentRatingKey'), metadata.get('parentIndex')
+    if not str(rating_key).isdigit() or not str(season).isdigit():
+        return None
+
+    return int(rating_key), int(season), metadata.get('grandparentTitle')
+
+
+class ScrobbleDebouncer:
+    def __init__(self, quiet_seconds: float = None, max_delay_seconds: float = None):
+        """ Collects the seasons watched in plex and queues one targeted sync for them once watching stops.
+
+        A season is synced once it hasn't been watched for the quiet period, or once its first episode
+        has waited the max delay so a long binge still reaches MyAnimeList.
+
+        :param quiet_seconds: Seconds without another watched episode before a season is synced.
+        :param max_delay_seconds: The longest a watched episode waits to be synced.
+        """
+        self.quiet_seconds = config.WEBHOOK_DEBOUNCE_MINUTES * 60 if quiet_seconds is None else quiet_seconds
+        self.max_delay_seconds = config.WEBHOOK_MAX_DELAY_MINUTES * 60 if max_delay_seconds is None else max_delay_seconds
+        # (rating key, season number) to [first watched, last watched, title]
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def add(self, rating_key: int, season: int, title: str) -> None:
+        with self._condition:
+            now = time.time()
+            entry = self._pending.setdefault((rating_key, season), [now, now, title])
+            entry[1] = now
+            log(f"Plex reported {title} season {season} as watched")
+
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._run, daemon = True)
+                self._thread.start()
+            self._condition.notify()
+
+    def pending(self) -> list:
+        """ Gets the seasons waiting to be synced and when they will be. """
+        with self._condition:
+            return [{'rating_key': k[0], 'season': k[1], 'title': v[2], 'sync_at': self._due_at(v)}
+                    for k, v in self._pending.items()]
+
+    def _due_at(self, entry: list) -> float:
+        return min(entry[1] + self.quiet_seconds, entry[0] + self.max_delay_seconds)
+
+    def _run(self) -> None:
+        with self._condition:
+            while True:
+                now = time.time()
+                due = [k for k, v in self._pending.items() if self._due_at(v) <= now]
+                if len(due) > 0:
+                    targets = {}
+                    for rating_key, season in due:
+                        targets.setdefault(rating_key, set()).add(season)
+                        del self._pending[(rating_key, season)]
+
+                    log(f"Queueing sync for {len(due)} recently watched seasons")
+                    sync_queue.submit(targets = targets)
+
+                next_due = min((self._due_at(x) for x in self._pending.values()), default = None)
+                self._condition.wait(None if next_due is None else max(next_due - now, 0))
+
+
+scrobble_debouncer = ScrobbleDebouncer()
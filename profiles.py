@@ -0,0 +1,62 @@
+import os
+import re
+import sys
+
+import config
+
+DEFAULT_PROFILE = 'default'
+
+
+class Profile:
+    def __init__(self, name: str, library: str, mal_username: str, mal_password: str,
+                 server_url: str = None, server_token: str = None):
+        """ A plex library that is synced to a MyAnimeList account.
+
+        Every profile keeps its own sync state and recent updates, the default profile uses the
+        same files as before profiles existed.
+
+        :param name: Name of the profile used in its file names.
+        :param library: The name of the plex library.
+        :param mal_username: The MyAnimeList account the library is synced to.
+        :param mal_password: The password for the MyAnimeList account.
+        :param server_url: The plex server the library is on, defaults to SERVER_URL.
+        :param server_token: The token for the plex server, defaults to SERVER_TOKEN.
+        """
+        self.name = name
+        self.library = library
+        self.mal_username = mal_username
+        self.mal_password = mal_password
+        self.server_url = server_url or config.SERVER_URL
+        self.server_token = server_token or config.SERVER_TOKEN
+
+        if name == DEFAULT_PROFILE:
+            self.sync_state_path = config.SYNC_STATE_PATH
+            self.sync_plan_path = config.SYNC_PLAN_PATH
+            self.recent_updates_path = config.RECENT_UPDATES_PATH
+        else:
+            self.sync_state_path = os.path.join(config.DATA_PATH, f'sync_state_{name}.json')
+            self.sync_plan_path = os.path.join(config.DATA_PATH, f'sync_plan_{name}.json')
+            self.recent_updates_path = os.path.join(config.DATA_PATH, f'recent_updates_{name}.json')
+
+    def to_dict(self) -> dict:
+        return {'name': self.name, 'library': self.library, 'mal_username': self.mal_username}
+
+
+def load_profiles() -> list:
+    """ Creates the default profile from the main config values and any extra profiles from PROFILES. """
+    profiles = [Profile(DEFAULT_PROFILE, config.LIBRARY, config.MAL_USERNAME, config.MAL_PASSWORD)]
+    for data in config.PROFILES:
+        name = str(data.get('name', ''))
+        missing = [k for k in ('LIBRARY', 'MAL_USERNAME', 'MAL_PASSWORD') if not data.get(k)]
+        if not re.fullmatch(r'[A-Za-z0-9_-]+', name) or name in [x.name for x in profiles] or len(missing) > 0:
+            print(f"Please give profile {name} a unique name of letters, numbers, - and _ and fill in: "
+                  + ", ".join(missing))
+            sys.exit()
+
+        profiles.append(Profile(name, data.get('LIBRARY'), data.get('MAL_USERNAME'), data.get('MAL_PASSWORD'),
+                                data.get('SERVER_URL'), data.get('SERVER_TOKEN')))
+
+    return profiles
+
+
+profiles = load_profiles()
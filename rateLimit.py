@@ -0,0 +1,60 @@
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1):
+        """ Thread safe token bucket rate limiter.
+
+        :param rate: The number of tokens added per second.
+        :param capacity: The maximum number of tokens that can be saved up for a burst.
+        :raises ValueError: If the rate isn't above zero.
+        """
+        if not rate > 0:
+            raise ValueError(f"Rate must be above 0 not {rate}")
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """ Blocks until a token is available and takes it. """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class HostRateLimiter:
+    def __init__(self, rate: float, capacity: float = 1):
+        """ Keeps a separate token bucket for every host requests are made to.
+
+        :param rate: The number of requests allowed per second for each host.
+        :param capacity: The number of requests each host allows in a burst.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, url: str) -> None:
+        """ Blocks until a request can be made to the host of the url. """
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, self.capacity)
+            bucket = self._buckets.get(host)
+
+        bucket.acquire()
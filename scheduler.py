@@ -0,0 +1,246 @@
+import random
+import re
+import threading
+from datetime import datetime, timedelta
+from typing import Optional
+
+from colorama import Fore
+
+import config
+from dashboardState import dashboard_state
+from syncJobs import sync_queue
+from utils import log
+
+# The scheduler sleeps until the next run but wakes at least this often to notice wall clock changes
+MAX_SLEEP_SECONDS = 3600
+# Cron expressions that don't match any day in this many days are rejected
+MAX_CRON_DAYS = 366 * 5
+INTERVAL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+CRON_FIELDS = (('minute', 0, 59), ('hour', 0, 23), ('day of month', 1, 31), ('month', 1, 12), ('day of week', 0, 7))
+
+
+class DailyTrigger:
+    def __init__(self, times: list):
+        """ Trigger that fires at the same times every day.
+
+        :param times: List of 24 hour times such as 19:00.
+        """
+        self.times = sorted(parse_time(x) for x in times)
+
+    def next_after(self, dt: datetime) -> datetime:
+        for day in (dt, dt + timedelta(days = 1)):
+            for hour, minute in self.times:
+                candidate = day.replace(hour = hour, minute = minute, second = 0, microsecond = 0)
+                if candidate > dt:
+                    return candidate
+
+    def __str__(self):
+        return ','.join(f'{h:02}:{m:02}' for h, m in self.times)
+
+
+class IntervalTrigger:
+    def __init__(self, seconds: float):
+        """ Trigger that fires a fixed time after the previous run. """
+        if seconds <= 0:
+            raise ValueError("the interval must be positive")
+        self.seconds = seconds
+
+    def next_after(self, dt: datetime) -> datetime:
+        return dt + timedelta(seconds = self.seconds)
+
+    def __str__(self):
+        return f'every {self.seconds:g}s'
+
+
+class CronTrigger:
+    def __init__(self, expression: str):
+        """ Trigger for a standard five field cron expression: minute hour day-of-month month day-of-week.
+
+        Fields may be *, numbers, ranges such as 1-5, steps such as */15 and comma separated lists of these.
+        Day of week is 0-7 where both 0 and 7 are Sunday.
+        """
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError("cron expressions need 5 fields")
+
+        values = [parse_cron_field(field, low, high) for field, (_, low, high) in zip(fields, CRON_FIELDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = values
+        self.weekdays = {x % 7 for x in weekdays}
+        # When both day fields are restricted cron runs on days that match either of them
+        self.restrict_days = fields[2] != '*'
+        self.restrict_weekdays = fields[4] != '*'
+
+        if self.next_after(datetime.now()) is None:
+            raise ValueError("the expression never matches")
+
+    def _day_matches(self, day: datetime) -> bool:
+        if day.month not in self.months:
+            return False
+
+        day_match = day.day in self.days
+        # Cron counts the week from Sunday and python from Monday
+        weekday_match = (day.weekday() + 1) % 7 in self.weekdays
+        if self.restrict_days and self.restrict_weekdays:
+            return day_match or weekday_match
+        return day_match and weekday_match
+
+    def next_after(self, dt: datetime) -> Optional[datetime]:
+        start = dt.replace(second = 0, microsecond = 0) + timedelta(minutes = 1)
+        day = start.replace(hour = 0, minute = 0)
+        for _ in range(MAX_CRON_DAYS):
+            if self._day_matches(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        candidate = day.replace(hour = hour, minute = minute)
+                        if candidate >= start:
+                            return candidate
+            day += timedelta(days = 1)
+
+        return None
+
+    def __str__(self):
+        return self.expression
+
+
+def parse_time(text: str) -> tuple:
+    """ Parses a 24 hour time such as 19:00 into an (hour, minute) tuple. """
+    match = re.fullmatch(r'(\d{1,2}):(\d{2})', text.strip())
+    if match is None or int(match.group(1)) > 23 or int(match.group(2)) > 59:
+        raise ValueError(f"{text} isn't a valid time")
+
+    return int(match.group(1)), int(match.group(2))
+
+
+def parse_cron_field(field: str, low: int, high: int) -> list:
+    """ Parses one field of a cron expression.
+
+    :return: Sorted list of the values the field matches.
+    """
+    values = set()
+    for part in field.split(','):
+        match = re.fullmatch(r'(\*|(\d+)(?:-(\d+))?)(?:/(\d+))?', part)
+        if match is None:
+            raise ValueError(f"{field} isn't a valid cron field")
+
+        if match.group(1) == '*':
+            start, end = low, high
+        else:
+            start = int(match.group(2))
+            # A single value with a step runs from that value to the end of the range
+            end = int(match.group(3)) if match.group(3) else (high if match.group(4) else start)
+
+        step = int(match.group(4) or 1)
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError(f"{field} is out of range {low}-{high}")
+
+        values.update(range(start, end + 1, step))
+
+    return sorted(values)
+
+
+def parse_trigger(spec: str):
+    """ Parses a schedule entry from the config.
+
+    :param spec: A comma separated list of daily times such as 07:00,19:00, an interval such as every 6h
+                 or a five field cron expression.
+    :return: The trigger for the entry.
+    """
+    spec = spec.strip()
+    match = re.fullmatch(r'every\s+(\d+(?:\.\d+)?)\s*([smhd])', spec, re.IGNORECASE)
+    if match:
+        return IntervalTrigger(float(match.group(1)) * INTERVAL_UNITS.get(match.group(2).lower()))
+
+    if re.fullmatch(r'[\d:,\s]+', spec):
+        return DailyTrigger(spec.split(','))
+
+    return CronTrigger(spec)
+
+
+class ScheduledSync:
+    def __init__(self, trigger, full: bool, jitter: float = 0):
+        """ A sync that is queued whenever its trigger fires.
+
+        :param trigger: Trigger that gives the time of the next run.
+        :param full: Whether the sync scans the whole library.
+        :param jitter: Up to this many seconds are added to every run at random.
+        """
+        self.trigger = trigger
+        self.full = full
+        self.jitter = jitter
+        # The time the trigger fired without jitter and the time the sync will actually be queued
+        self.scheduled = None
+        self.next_run = None
+
+    def schedule_after(self, dt: datetime) -> None:
+        self.scheduled = self.trigger.next_after(dt)
+        self.next_run = self.scheduled + timedelta(seconds = random.uniform(0, self.jitter))
+
+    def to_dict(self) -> dict:
+        return {'trigger' : str(self.trigger),
+                'full'    : self.full,
+                'next_run': self.next_run.timestamp() if self.next_run is not None else None}
+
+
+class Scheduler:
+    def __init__(self):
+        """ Queues the scheduled syncs, sleeping until the next one is due rather than polling. """
+        self.entries = []
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def add(self, trigger, full: bool = False, jitter: float = 0) -> ScheduledSync:
+        entry = ScheduledSync(trigger, full, jitter)
+        with self._condition:
+            entry.schedule_after(datetime.now())
+            self.entries.append(entry)
+            self._update_next_run()
+            # Wake the thread in case the new entry is due before the one it is waiting for
+            self._condition.notify()
+
+        return entry
+
+    def load_config(self) -> None:
+        """ Adds the incremental and full sync schedules from the config, logging any invalid entries. """
+        jitter = config.SYNC_JITTER_MINUTES * 60
+        for specs, full in ((config.SYNC_SCHEDULE, False), (config.FULL_SYNC_SCHEDULE, True)):
+            for spec in specs:
+                try:
+                    self.add(parse_trigger(spec), full, jitter)
+                except ValueError as e:
+                    log(f"Ignoring invalid sync schedule {spec}: {e}", Fore.RED)
+
+    def next_runs(self) -> list:
+        """ Gets the scheduled syncs ordered by their next run. """
+        with self._condition:
+            return sorted((x.to_dict() for x in self.entries), key = lambda x: x.get('next_run'))
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def _update_next_run(self) -> None:
+        next_run = min((x.next_run for x in self.entries), default = None)
+        dashboard_state.update(next_run = next_run.timestamp() if next_run is not None else None)
+
+    def _run(self) -> None:
+        with self._condition:
+            while True:
+                now = datetime.now()
+                due = [x for x in self.entries if x.next_run <= now]
+                if len(due) > 0:
+                    # A full sync covers an incremental one that is due at the same time
+                    sync_queue.submit(full = any(x.full for x in due))
+                    for entry in due:
+                        entry.schedule_after(entry.scheduled)
+                        # Skip the runs that were missed while the computer was asleep
+                        if entry.next_run <= now:
+                            entry.schedule_after(now)
+                    self._update_next_run()
+
+                next_run = min((x.next_run for x in self.entries), default = None)
+                timeout = MAX_SLEEP_SECONDS if next_run is None else (next_run - now).total_seconds()
+                self._condition.wait(min(max(timeout, 0), MAX_SLEEP_SECONDS))
+
+
+scheduler = Scheduler()
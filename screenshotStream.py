@@ -0,0 +1,103 @@
+import hashlib
+import threading
+import time
+from typing import Optional
+
+import config
+import metrics
+
+SCREENSHOT_ROOM = 'driver_screenshots'
+
+
+class Frame:
+    def __init__(self, png: bytes, captured_at: float):
+        """ A screenshot of the browser the sync is using.
+
+        :param png: The screenshot as png bytes.
+        :param captured_at: The time the screenshot was taken.
+        """
+        self.png = png
+        self.captured_at = captured_at
+        self.etag = hashlib.sha1(png).hexdigest()
+
+
+class ScreenshotStream:
+    def __init__(self, interval: float = None):
+        """ Shares screenshots of the sync's browser between every viewer without writing them to disk.
+
+        At most one screenshot is taken per interval however many viewers ask for one, and a viewer never
+        waits for a screenshot that is already being taken, so watching can't hold up the sync's browser.
+        Viewers subscribed over Socket.IO are sent new frames only when the page has changed.
+
+        :param interval: The minimum seconds between screenshots.
+        """
+        self.interval = config.SCREENSHOT_INTERVAL_SECONDS if interval is None else interval
+        self._frame = None
+        self._capture_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._subscribers = set()
+        self._thread = None
+
+    def get_frame(self) -> Optional[Frame]:
+        """ Gets the latest screenshot, taking a new one if the last is older than the interval.
+
+        :return: The latest frame or None if no browser is running.
+        """
+        driver = config.DRIVER
+        frame = self._frame
+        if driver is None:
+            return None
+
+        if frame is not None and time.time() - frame.captured_at < self.interval:
+            return frame
+
+        # Another viewer is already taking the screenshot so share the previous one instead of queueing,
+        # unless there isn't one yet
+        if not self._capture_lock.acquire(blocking = frame is None):
+            return frame
+
+        try:
+            frame = self._frame
+            if frame is not None and time.time() - frame.captured_at < self.interval:
+                return frame
+
+            with metrics.timed('browser_screenshot'):
+                png = driver.get_screenshot_as_png()
+            if png is not None:
+                self._frame = Frame(png, time.time())
+            return self._frame
+        finally:
+            self._capture_lock.release()
+
+    def subscribe(self, sid: str) -> None:
+        """ Starts pushing frames to a Socket.IO client that has joined the screenshot room. """
+        with self._condition:
+            self._subscribers.add(sid)
+            if self._thread is None:
+                self._thread = threading.Thread(target = self._run, daemon = True)
+                self._thread.start()
+
+    def unsubscribe(self, sid: str) -> None:
+        with self._condition:
+            self._subscribers.discard(sid)
+            self._condition.notify()
+
+    def _run(self) -> None:
+        last_etag = None
+        while True:
+            with self._condition:
+                if len(self._subscribers) == 0:
+                    self._thread = None
+                    return
+
+            frame = self.get_frame()
+            if frame is not None and frame.etag != last_etag:
+                last_etag = frame.etag
+                config.socketio.emit('driver_screenshot', {'image': frame.png, 'captured_at': frame.captured_at},
+                                     room = SCREENSHOT_ROOM, namespace = '/socket')
+
+            with self._condition:
+                self._condition.wait(self.interval)
+
+
+screenshot_stream = ScreenshotStream()
@@ -1,20 +1,34 @@
-from plexapi.video import Show
-from driver import Driver
+from browserPool import browser_pool
 from malList import MalList
+import malUpdater
 import mapping
+import metrics
 import config
 from plexConnection import PlexConnection
+from profiles import profiles, Profile
 from utils import log
 import utils
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from rateLimit import TokenBucket
+from syncPlan import SyncPlan
+from titleIndex import title_matcher
+import syncJobs
+
+# Held while a profile resolves its mappings
+mappings_lock = threading.Lock()
+# Updates that fail in this many syncs are given up on until plex or a full sync works them out again
+MAX_UPDATE_ATTEMPTS = 5
 
 
 def update_mal_tvdb_mappings(shows: list):
     log("Updating mal to tvdb mappings")
-    for show in shows:
-        title = show.title
-        tvdbid = show.guid.split('//')[1].rstrip('?lang=en')
-        seasons = [str(x.seasonNumber) for x in show.seasons() if x.seasonNumber != 0]
-        mapping.update_tvdb_mal_mapping(title, tvdbid, seasons, config.DRIVER)
+    resolved = mapping.update_tvdb_mal_mappings([(show.title, show.tvdb_id, [str(x) for x in sorted(show.seasons) if x != 0])
+                                      for show in shows])
+    syncJobs.add_progress('mappings_resolved', resolved)
 
     mapping.verify_mapping_errors()
 
@@ -31,105 +45,449 @@ def get_status(plex_watched_episodes: int, total_episodes: int) -> str:
     return status
 
 
-def process_seasons(show: Show, series_mapping: dict, title: str, mal_list: MalList, tvdb_id: str):
+def is_behind(plex_watched_eps: int, mal_data: dict) -> bool:
+    """ Checks whether MyAnimeList is behind plex for a season.
+
+    :param mal_data: The season's entry on the MyAnimeList list or an empty dictionary if it isn't on the list.
+    """
+    total_episodes = mal_data.get('anime_num_episodes')
+    mal_watched_eps = mal_data.get('num_watched_episodes') or 0
+    return not (len(mal_data) > 0 and plex_watched_eps <= mal_watched_eps or mal_watched_eps == total_episodes)
+
+
+def process_seasons(season_counts: dict, series_mapping: dict, title: str, mal_list: MalList, tvdb_id: str):
+    """ Finds the seasons of a show that are behind on MyAnimeList.
+
+    :param season_counts: Dictionary of season numbers to (episode count, watched episode count) tuples.
+    """
     to_update = []
-    for season in [x for x in show.seasons() if x.seasonNumber > 0]:
-        mal_id = series_mapping.get(str(season.seasonNumber))
+    for season_number, (_, plex_watched_eps) in sorted(season_counts.items()):
+        if season_number <= 0:
+            continue
+
+        mal_id = series_mapping.get(str(season_number))
 
         # When the season is unmapped
         if mal_id is None:
-            log(f"Unmapped season for {title} season: {season.seasonNumber}")
+            log(f"Unmapped season for {title} season: {season_number}")
             continue
 
         mal_data = mal_list.get_anime(mal_id) or {}
 
         total_episodes = mal_data.get('anime_num_episodes')
         mal_watched_eps = mal_data.get('num_watched_episodes') or 0
-        plex_watched_eps = len([x for x in season.episodes() if x.isWatched])
 
         # status = get_status(plex_watched_episodes, total_episodes)
 
-        if len(mal_data) > 0 and plex_watched_eps <= mal_watched_eps or mal_watched_eps == total_episodes:
+        if not is_behind(plex_watched_eps, mal_data):
             continue
 
         to_update.append({'title'           : title,
-                          'season'          : season.seasonNumber,
+                          'season'          : season_number,
                           'tvdb_id'         : tvdb_id,
                           'mal_id'          : mal_id,
                           'watched_episodes': plex_watched_eps,
-                          'mal_watched_eps' : mal_watched_eps})
+                          'mal_watched_eps' : mal_watched_eps,
+                          'total_episodes'  : total_episodes,
+                          'on_list'         : len(mal_data) > 0})
 
     return to_update
 
 
-def get_to_update(shows: list) -> list:
+def get_to_update(shows: list, mal_list: MalList) -> list:
     log("Getting shows to update")
     tvdbid_mal_mapping = mapping.get_tvdb_mal_mapping()
-    mal_list = MalList('SkippyTheSnake')
     to_update = []
     for show in shows:
         title = show.title
-        tvdb_id = show.guid.split('//')[1].rstrip('?lang=en')
+        tvdb_id = show.tvdb_id
         series_mapping = tvdbid_mal_mapping.get(tvdb_id)
         # When the series is unmapped
         if series_mapping is None:
             log(f"Unmapped series {title}")
             continue
 
-        to_update.extend(process_seasons(show, series_mapping, title, mal_list, tvdb_id))
+        to_update.extend(process_seasons(show.seasons, series_mapping, title, mal_list, tvdb_id))
 
     log(f"{len(to_update)} updates required")
     return to_update
 
 
+def add_retries(to_update: list, retries: list, mal_list: MalList) -> list:
+    """ Adds the updates that failed in earlier syncs to the ones worked out from plex.
+
+    :param to_update: List of the updates worked out from plex, these replace any retry of the same season.
+    :param retries: List of the failed updates saved in the sync state.
+    :return: List of the updates with the retries that MyAnimeList is still behind on.
+    """
+    planned = {(str(x.get('tvdb_id')), str(x.get('season'))): x for x in to_update}
+    for series in retries:
+        update = planned.get((str(series.get('tvdb_id')), str(series.get('season'))))
+        if update is not None:
+            update['attempts'] = series.get('attempts', 0)
+        elif is_behind(series.get('watched_episodes'), mal_list.get_anime(str(series.get('mal_id'))) or {}):
+            to_update.append(series)
+
+    return to_update
+
+
+def get_retries(failed: list) -> list:
+    """ Gets the failed updates to try again next sync, giving up on any that have failed too many times. """
+    retries = []
+    for series in failed:
+        if series.get('attempts', 0) >= MAX_UPDATE_ATTEMPTS:
+            log(f"Giving up on updating {series.get('title')} season {series.get('season')} after "
+                f"{series.get('attempts')} failed attempts")
+            continue
+
+        retries.append(series)
+
+    return retries
+
+
+def get_updater(profile: Profile):
+    """ Gets the MyAnimeList updater backend chosen in the config for a profile's account.
+
+    :return: The http updater when MAL_UPDATER is http otherwise the selenium driver.
+    """
+    if config.MAL_UPDATER == 'http':
+        return malUpdater.MalHttpUpdater(username = profile.mal_username, password = profile.mal_password)
+
+    # The browser is only started now that there is something to update
+    driver = browser_pool.acquire()
+    driver.set_account(profile.mal_username, profile.mal_password)
+    if config.DRIVER is None:
+        config.DRIVER = driver
+    return driver
+
+
+def release_updater(updater) -> None:
+    """ Returns a browser updater to the pool or closes any other updater. """
+    if isinstance(updater, malUpdater.MalHttpUpdater):
+        updater.quit()
+        return
+
+    if updater is config.DRIVER:
+        config.DRIVER = None
+    browser_pool.release(updater)
+
+
+def record_update(profile: Profile, series: dict, status: str) -> None:
+    """ Adds a completed update to the profile's recent updates and sends them to the web page. """
+    title = series.get('title')
+    season_no = series.get('season')
+    recent_updates = utils.get_recent_updates(profile)
+    watched_eps = series.get('watched_episodes')
+    mal_watched_eps = series.get('mal_watched_eps')
+
+    status = {'1': 'Watching', '2': 'Completed', '5': 'To watch'}.get(status)
+    eps_change = f" (Ep {mal_watched_eps} → {watched_eps}) " if mal_watched_eps != watched_eps else " "
+
+    recent_updates.append(f"{title} - Season {season_no}{eps_change}({status})")
+    utils.save_recent_updates(profile, recent_updates)
+    config.socketio.emit('recent_updates',
+                         {'profile'       : profile.name,
+                          'recent_updates': utils.format_recent_updates(utils.load_recent_updates())},
+                         namespace = '/socket')
+
+
+def apply_updates(to_update: list, mal_list: MalList, profile: Profile, plan: Optional[SyncPlan] = None) -> list:
+    """ Updates MyAnimeList using a pool of workers that each have their own logged in session.
+
+    Workers take the next update from a shared queue once they have logged in, so a worker that can't log in
+    leaves its share to the ones that did. Each worker gives its browser back to the pool as soon as it stops,
+    so profiles syncing at the same time can't each hold browsers the others are waiting for. Every worker
+    shares one rate limit and the results are recorded in the order of to_update. Successful updates are
+    applied to the local copy of the list straight away.
+
+    :param to_update: List of the series to update.
+    :param mal_list: The local copy of the MyAnimeList list.
+    :param profile: The profile whose MyAnimeList account is updated.
+    :param plan: The saved plan the updates come from, each update made is recorded in its journal.
+    :return: List of the series that weren't updated, including all of them if no worker could log in.
+             The attempts of the ones that were tried and failed are counted up. Seasons whose MyAnimeList
+             page doesn't exist are recorded as mapping errors instead.
+    """
+    workers = min(config.MAL_UPDATE_WORKERS, len(to_update))
+    if config.MAL_UPDATER != 'http':
+        # Workers beyond the pool size would only wait for a browser another worker has finished with
+        workers = min(workers, browser_pool.size)
+
+    rate_limiter = TokenBucket(config.MAL_UPDATES_PER_SECOND)
+    pending = queue.Queue()
+    for index, series in enumerate(to_update):
+        pending.put((index, series))
+    # Workers put (index, status) for every update they make and (None, None) when they stop
+    results = queue.Queue()
+    logins = []
+    lock = threading.Lock()
+
+    def work() -> None:
+        updater = None
+        try:
+            # The updates may have all been made while this worker waited for a browser
+            if pending.empty():
+                return
+
+            logged_in = False
+            try:
+                updater = get_updater(profile)
+                logged_in = updater.login_myanimelist()
+            except Exception as e:
+                log(f"Failed to start MyAnimeList session: {e}")
+
+            with lock:
+                logins.append(logged_in)
+
+            while logged_in and not syncJobs.is_cancelled():
+                try:
+                    index, series = pending.get_nowait()
+                except queue.Empty:
+                    return
+
+                rate_limiter.acquire()
+                try:
+                    with metrics.timed('update_series'):
+                        status = updater.update_series(series)
+                except Exception as e:
+                    # A failure in one worker shouldn't stop the others
+                    log(f"Failed to update {series.get('title')} season {series.get('season')}: {e}")
+                    status = None
+                results.put((index, status))
+        finally:
+            if updater is not None:
+                release_updater(updater)
+            results.put((None, None))
+
+    failed = []
+
+    def record(series: dict, status: Optional[str]) -> None:
+        if status is not None:
+            record_update(profile, series, status)
+            syncJobs.add_progress('updates_applied')
+            total_episodes = series.get('total_episodes')
+            watched_episodes = series.get('watched_episodes')
+            mal_list.apply_update(series.get('mal_id'), min(watched_episodes, total_episodes or watched_episodes),
+                                  status, total_episodes)
+        # A mal id whose page couldn't be loaded needs the user to fix the mapping before it is tried again
+        elif not mapping.has_mapping_error(series.get('tvdb_id'), str(series.get('season'))):
+            failed.append(dict(series, attempts = series.get('attempts', 0) + 1))
+            return
+
+        if plan is not None:
+            plan.mark_done(series, status)
+
+    statuses = {}
+    next_index = 0
+    try:
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            for _ in range(workers):
+                executor.submit(work)
+
+            finished = 0
+            while finished < workers:
+                index, status = results.get()
+                if index is None:
+                    finished += 1
+                    continue
+
+                statuses[index] = status
+                while next_index in statuses:
+                    record(to_update[next_index], statuses.pop(next_index))
+                    next_index += 1
+    finally:
+        # Record anything that finished after an update that never did
+        for index in sorted(statuses):
+            record(to_update[index], statuses.pop(index))
+        mal_list.save()
+
+    syncJobs.check_cancelled()
+    if not any(logins):
+        log(f"Failed to log into MyAnimeList as {profile.mal_username}")
+
+    # The updates left in the queue were never tried because every worker that logged in has stopped
+    while not pending.empty():
+        failed.append(pending.get()[1])
+
+    return failed
+
+
 def script_init():
     log("Initialising")
-    # Start driver
-    config.DRIVER = Driver()
-
     # Ensure mapping file downloads are up to date
-    mapping.update_mapping_xml()
+    with metrics.timed('mapping_refresh'):
+        mapping.update_mapping_xml()
+    # The title index is rebuilt in the background if the mapping changed
+    title_matcher.warm()
     log("Initialisation complete")
 
 
-def do_sync():
-    log("Starting sync")
-    script_init()
-    plex = PlexConnection(config.SERVER_URL, config.SERVER_TOKEN)
-    shows = plex.get_shows("Anime")
+def is_full_sync_due(sync_state: dict) -> bool:
+    """ Checks whether the library needs a full scan rather than only the shows watched since the last sync. """
+    if sync_state.get('watermark') is None:
+        return True
 
-    update_mal_tvdb_mappings(shows)
+    return time.time() - sync_state.get('last_full_sync', 0) >= config.FULL_SYNC_INTERVAL_HOURS * 3600
 
-    to_update = get_to_update(shows)
 
-    if len(to_update) > 0:
-        logged_in = config.DRIVER.login_myanimelist()
+def do_sync(full: bool = False, targets: Optional[dict] = None):
+    """ Syncs the watched episodes from plex to MyAnimeList.
 
-        # If the login fails cancel the sync
-        if not logged_in:
-            log("Failed to log into MyAnimeList")
-            return
+    :param full: Scan the whole library even if a full scan isn't due yet.
+    :param targets: Dictionary of plex rating keys to sets of season numbers to only sync those seasons.
+    """
+    with metrics.timed('sync' if targets is None else 'targeted_sync'):
+        _do_sync(full, targets)
 
-        for series in to_update:
-            status = config.DRIVER.update_series(series)
 
-            # When the driver failed to load the page because of a MyAnimeList url error
-            if status is None:
-                continue
+def _do_sync(full: bool, targets: Optional[dict]):
+    log("Starting sync" if targets is None else f"Starting sync of {len(targets)} recently watched shows")
+    syncJobs.set_phase('initialising')
+    script_init()
+
+    # Every profile syncs at the same time sharing the mapping index, anidb cache and browser pool
+    syncJobs.set_phase('syncing profiles')
+    with ThreadPoolExecutor(max_workers = len(profiles)) as executor:
+        futures = [(x, executor.submit(sync_profile, x, full, targets)) for x in profiles]
 
-            title = series.get('title')
-            season_no = series.get('season')
-            recent_updates = utils.get_recent_updates()
-            watched_eps = series.get('watched_episodes')
-            mal_watched_eps = series.get('mal_watched_eps')
+    errors = []
+    for profile, future in futures:
+        error = future.exception()
+        if error is None:
+            continue
 
-            status = {'1': 'Watching', '2': 'Completed', '5': 'To watch'}.get(status)
-            eps_change = f" (Ep {mal_watched_eps} → {watched_eps}) " if mal_watched_eps != watched_eps else " "
+        # The job logs the error itself so only say which profile failed when there is more than one
+        if len(profiles) > 1 and not isinstance(error, syncJobs.SyncCancelled):
+            log(f"Sync failed for profile {profile.name}: {error}")
+        errors.append(error)
 
-            recent_updates.append(f"{title} - Season {season_no}{eps_change}({status})")
-            config.socketio.emit('recent_updates', {'recent_updates': "\n".join(recent_updates)},
-                                 namespace = '/socket')
-            utils.save_recent_updates(recent_updates)
+    if len(errors) > 0:
+        # Report a cancellation over any other failure
+        raise next((x for x in errors if isinstance(x, syncJobs.SyncCancelled)), errors[0])
 
-        config.DRIVER.quit()
     log("Sync complete")
+
+
+def plan_profile(profile: Profile, full: bool, targets: Optional[dict], sync_state: dict) -> Optional[tuple]:
+    """ Scans plex and the MyAnimeList list to work out the updates a profile needs.
+
+    :return: Tuple of the list of updates, the MyAnimeList list and the library snapshot or None if the
+             library couldn't be found.
+    """
+    syncJobs.set_phase('scanning plex')
+    with metrics.timed('plex_scan'):
+        plex = PlexConnection(profile.server_url, profile.server_token)
+        if targets is not None:
+            snapshot = plex.get_shows_snapshot(profile.library, targets)
+        else:
+            snapshot = plex.get_library_snapshot(profile.library, None if full else sync_state.get('watermark'))
+    if snapshot is None:
+        log(f"Failed to find the library {profile.library} on the plex server")
+        return None
+
+    shows = snapshot.shows
+    syncJobs.add_progress('shows_scanned', len(shows))
+
+    syncJobs.set_phase('resolving mappings')
+    # Profiles resolve one at a time so shows in more than one library are only looked up on anidb once
+    with mappings_lock, metrics.timed('resolve_mappings'):
+        update_mal_tvdb_mappings(shows)
+
+    syncJobs.set_phase('checking list')
+    with metrics.timed('mal_list_load'):
+        mal_list = MalList(profile.mal_username)
+    # Targeted syncs leave the updates that failed before to the next scheduled sync
+    retries = sync_state.get('retries', []) if targets is None else []
+    with metrics.timed('diff'):
+        to_update = add_retries(get_to_update(shows, mal_list), retries, mal_list)
+
+    # The saved copy of the list may be missing changes made on MyAnimeList since it was loaded, which the
+    # updates would overwrite, so check it is current before making any
+    if len(to_update) > 0 and not mal_list.refreshed:
+        with metrics.timed('mal_list_load'):
+            mal_list.refresh()
+        with metrics.timed('diff'):
+            to_update = add_retries(get_to_update(shows, mal_list), retries, mal_list)
+
+    return to_update, mal_list, snapshot
+
+
+def sync_profile(profile: Profile, full: bool, targets: Optional[dict]) -> None:
+    """ Syncs the watched episodes of a profile's plex library to its MyAnimeList account.
+
+    The updates are saved as a plan before any are made so if the sync stops part way through the next sync
+    carries on with the ones that are left instead of working them out again. A full sync discards any
+    unfinished plan. Updates that fail are saved in the sync state and tried again by the next syncs, up to
+    MAX_UPDATE_ATTEMPTS times, so the watermark still moves on and one bad update can't stop incremental syncs.
+
+    :param profile: The profile to sync.
+    :param full: Scan the whole library even if a full scan isn't due yet.
+    :param targets: Dictionary of plex rating keys to sets of season numbers to only sync those seasons.
+    """
+    syncJobs.set_profile(profile.name)
+    try:
+        _sync_profile(profile, full, targets)
+    finally:
+        syncJobs.set_profile(None)
+
+
+def _sync_profile(profile: Profile, full: bool, targets: Optional[dict]) -> None:
+    log(f"Syncing library {profile.library} to MyAnimeList user {profile.mal_username}")
+    sync_state = utils.load_json(profile.sync_state_path) or {}
+    full = targets is None and (full or is_full_sync_due(sync_state))
+
+    # Targeted syncs are small enough to not need a plan and leave any unfinished plan for the next sync
+    plan = SyncPlan.load(profile.sync_plan_path) if targets is None else None
+    if plan is not None and full:
+        # A full sync works out every update again, including the ones left in the plan that are still needed
+        log("Discarding unfinished sync plan as a full sync was started")
+        plan.discard()
+        plan = None
+
+    if plan is not None:
+        to_update = plan.remaining()
+        log(f"Resuming unfinished sync with {len(to_update)} of {len(plan.items)} updates left")
+        syncJobs.add_progress('updates_applied', len(plan.items) - len(to_update))
+        with metrics.timed('mal_list_load'):
+            mal_list = MalList(profile.mal_username)
+            if len(to_update) > 0 and not mal_list.refreshed:
+                mal_list.refresh()
+        # Leave out anything that has been changed on MyAnimeList since the plan was made
+        to_update = [x for x in to_update
+                     if is_behind(x.get('watched_episodes'), mal_list.get_anime(str(x.get('mal_id'))) or {})]
+        watermark, scanned_full = plan.watermark, plan.full
+    else:
+        result = plan_profile(profile, full, targets, sync_state)
+        if result is None:
+            return
+
+        to_update, mal_list, snapshot = result
+        watermark, scanned_full = snapshot.watermark, snapshot.full
+        if targets is None and len(to_update) > 0:
+            plan = SyncPlan.create(profile.sync_plan_path, to_update, watermark, scanned_full)
+
+    failed = []
+    if len(to_update) > 0:
+        syncJobs.set_phase('updating')
+        syncJobs.add_progress('updates_total', len(plan.items) if plan is not None else len(to_update))
+        with metrics.timed('apply_updates'):
+            failed = apply_updates(to_update, mal_list, profile, plan)
+
+    # Targeted syncs skip the rest of the library so the scheduled syncs still need to look at everything since
+    # the watermark
+    if targets is not None:
+        return
+
+    retries = get_retries(failed)
+    if len(retries) > 0:
+        log(f"{len(retries)} updates for {profile.mal_username} failed and will be tried again next sync")
+
+    # Only move the watermark on once the sync has finished so stopped runs are retried, failed updates are kept
+    # separately
+    sync_state['retries'] = retries
+    sync_state['watermark'] = max(watermark, sync_state.get('watermark') or 0)
+    if scanned_full:
+        sync_state['last_full_sync'] = time.time()
+    utils.save_json(sync_state, profile.sync_state_path)
+    if plan is not None:
+        plan.discard()
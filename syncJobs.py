@@ -0,0 +1,222 @@
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional
+
+from utils import log
+
+# Number of finished jobs kept for the status api
+JOB_HISTORY = 20
+PROGRESS_KEYS = ('shows_scanned', 'mappings_resolved', 'updates_applied', 'updates_total')
+# The profile each sync thread is working on so its phase and progress are kept separately from the others
+_thread_profile = threading.local()
+
+
+class SyncCancelled(Exception):
+    pass
+
+
+class SyncJob:
+    def __init__(self, full: bool, targets: Optional[dict] = None):
+        """ A single queued or running sync.
+
+        :param full: Whether the sync scans the whole library.
+        :param targets: Dictionary of plex rating keys to sets of season numbers when only those seasons are synced.
+        """
+        self.id = uuid.uuid4().hex[:12]
+        self.full = full
+        self.targets = targets
+        self.state = 'queued'
+        self.phase = None
+        # Progress of the whole job and the phase and progress of every profile by its name
+        self.progress = {k: 0 for k in PROGRESS_KEYS}
+        self.profiles = {}
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+
+    def to_dict(self) -> dict:
+        return {'job_id'     : self.id,
+                'full'       : self.full,
+                'targets'    : {str(k): sorted(v) for k, v in self.targets.items()} if self.targets else None,
+                'state'      : self.state,
+                'phase'      : self.phase,
+                'progress'   : dict(self.progress),
+                'profiles'   : {k: {'phase': v.get('phase'), 'progress': dict(v.get('progress'))}
+                                for k, v in list(self.profiles.items())},
+                'error'      : self.error,
+                'created_at' : self.created_at,
+                'started_at' : self.started_at,
+                'finished_at': self.finished_at}
+
+
+class SyncQueue:
+    def __init__(self):
+        """ Runs the manual and scheduled syncs one at a time on a background thread. """
+        self.runner = None
+        self.on_state_change = None
+        self.current = None
+        self._jobs = OrderedDict()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def start(self, runner, on_state_change = None) -> None:
+        """ Starts the worker thread.
+
+        :param runner: Function called with the full flag and targets to run a sync.
+        :param on_state_change: Function called with True when a sync starts and False when it ends.
+        """
+        self.runner = runner
+        self.on_state_change = on_state_change
+        self._worker = threading.Thread(target = self._run, daemon = True)
+        self._worker.start()
+
+    def submit(self, full: bool = False, targets: Optional[dict] = None) -> SyncJob:
+        """ Queues a sync unless an equivalent one is already waiting or running.
+
+        :param full: Whether the sync should scan the whole library.
+        :param targets: Dictionary of plex rating keys to sets of season numbers to only sync those seasons.
+        :return: The new job or the existing job that covers this request.
+        """
+        with self._lock:
+            pending = [x for x in self._jobs.values() if x.state in ('queued', 'running')]
+            for job in pending:
+                if job.state == 'queued':
+                    job.full = job.full or full
+                    # A queued job that syncs every show covers any targets, otherwise the targets are merged
+                    if targets is None:
+                        job.targets = None
+                    elif job.targets is not None:
+                        for rating_key, seasons in targets.items():
+                            job.targets.setdefault(rating_key, set()).update(seasons)
+                    return job
+
+                # A running job may have already scanned plex before the targeted episodes were watched
+                if job.state == 'running' and targets is None and (job.full or not full):
+                    return job
+
+            job = SyncJob(full, targets)
+            self._jobs[job.id] = job
+            self._trim_history()
+
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[SyncJob]:
+        return self._jobs.get(job_id)
+
+    def jobs(self) -> list:
+        return list(self._jobs.values())
+
+    def cancel(self, job_id: str) -> Optional[SyncJob]:
+        """ Cancels a queued job or asks a running job to stop at its next checkpoint. """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job.state in ('queued', 'running'):
+                job.cancel_event.set()
+                if job.state == 'queued':
+                    job.state = 'cancelled'
+
+        return job
+
+    def _trim_history(self) -> None:
+        finished = [k for k, v in self._jobs.items() if v.state not in ('queued', 'running')]
+        for job_id in finished[:max(0, len(self._jobs) - JOB_HISTORY)]:
+            del self._jobs[job_id]
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            # Submits merge into a job while it is queued so it only starts once none can be changing it, and the
+            # runner is given its own copy of the targets
+            with self._lock:
+                if job.cancel_event.is_set():
+                    continue
+
+                job.state = 'running'
+                job.started_at = time.time()
+                self.current = job
+                full = job.full
+                targets = {k: set(v) for k, v in job.targets.items()} if job.targets is not None else None
+
+            if self.on_state_change is not None:
+                self.on_state_change(True)
+
+            state, error = 'failed', None
+            try:
+                self.runner(full, targets)
+                state = 'completed'
+            except SyncCancelled:
+                log("Sync cancelled")
+                state = 'cancelled'
+            except Exception as e:
+                log(f"Sync failed: {e}")
+                error = str(e)
+            finally:
+                # A submit seeing the job as still running relies on it not having finished
+                with self._lock:
+                    job.state, job.error = state, error
+                    job.finished_at = time.time()
+                    self.current = None
+                if self.on_state_change is not None:
+                    self.on_state_change(False)
+
+
+sync_queue = SyncQueue()
+
+
+def set_profile(name: Optional[str]) -> None:
+    """ Sets the profile the current thread is syncing, phases and progress are recorded against it. """
+    _thread_profile.name = name
+
+
+def _get_profile_status(job: SyncJob) -> Optional[dict]:
+    name = getattr(_thread_profile, 'name', None)
+    if name is None:
+        return None
+
+    return job.profiles.setdefault(name, {'phase': None, 'progress': {k: 0 for k in PROGRESS_KEYS}})
+
+
+def set_phase(phase: str) -> None:
+    """ Records the phase the running sync, or the profile the thread is syncing, is in and stops the sync if it
+    has been cancelled.
+    """
+    check_cancelled()
+    job = sync_queue.current
+    if job is None:
+        return
+
+    with sync_queue._lock:
+        profile_status = _get_profile_status(job)
+        if profile_status is None:
+            job.phase = phase
+        else:
+            profile_status['phase'] = phase
+
+
+def add_progress(key: str, amount: int = 1) -> None:
+    """ Adds to one of the progress counters of the running sync and the profile the thread is syncing. """
+    job = sync_queue.current
+    if job is not None:
+        with sync_queue._lock:
+            job.progress[key] = job.progress.get(key, 0) + amount
+            profile_status = _get_profile_status(job)
+            if profile_status is not None:
+                profile_status['progress'][key] = profile_status['progress'].get(key, 0) + amount
+
+
+def is_cancelled() -> bool:
+    job = sync_queue.current
+    return job is not None and job.cancel_event.is_set()
+
+
+def check_cancelled() -> None:
+    """ Raises SyncCancelled if the running sync has been cancelled. """
+    if is_cancelled():
+        raise SyncCancelled()
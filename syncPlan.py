@@ -0,0 +1,93 @@
+import json
+import os
+import time
+from typing import Optional
+
+import config
+import utils
+from utils import log
+
+
+def get_key(series: dict) -> tuple:
+    return str(series.get('tvdb_id')), str(series.get('season')), str(series.get('mal_id'))
+
+
+class SyncPlan:
+    def __init__(self, filepath: str, data: dict):
+        """ The updates a sync worked out it needs to make, saved so a failed sync can carry on where it stopped.
+
+        Every update that is made is appended to a journal next to the plan so a restarted sync only makes
+        the ones that are left.
+
+        :param filepath: Path to the plan file.
+        :param data: The saved plan with the items, the plex watermark and whether the library was fully scanned.
+        """
+        self.filepath = filepath
+        self.journal_filepath = f'{filepath}.journal'
+        self.items = data.get('items', [])
+        self.watermark = data.get('watermark', 0)
+        self.full = data.get('full', False)
+        self.created_at = data.get('created_at', 0)
+        self.done = set()
+
+    @staticmethod
+    def create(filepath: str, items: list, watermark: int, full: bool) -> 'SyncPlan':
+        """ Saves a new plan and clears the journal of any previous one. """
+        data = {'items': items, 'watermark': watermark, 'full': full, 'created_at': time.time()}
+        utils.save_json(data, filepath)
+        plan = SyncPlan(filepath, data)
+        if os.path.exists(plan.journal_filepath):
+            os.remove(plan.journal_filepath)
+        return plan
+
+    @staticmethod
+    def load(filepath: str, ttl: float = None) -> Optional['SyncPlan']:
+        """ Loads an unfinished plan and its journal.
+
+        :param ttl: Seconds before a plan is too old to resume, defaults to SYNC_PLAN_TTL_HOURS.
+        :return: The plan or None if there isn't one or it has expired.
+        """
+        ttl = config.SYNC_PLAN_TTL_HOURS * 3600 if ttl is None else ttl
+        try:
+            data = utils.load_json(filepath)
+        except ValueError:
+            data = None
+
+        if data is None:
+            return None
+
+        plan = SyncPlan(filepath, data)
+        if time.time() - plan.created_at >= ttl:
+            log("Discarding unfinished sync plan as it is too old to resume")
+            plan.discard()
+            return None
+
+        if os.path.exists(plan.journal_filepath):
+            with open(plan.journal_filepath, 'r') as f:
+                for line in f:
+                    try:
+                        plan.done.add(get_key(json.loads(line)))
+                    except ValueError:
+                        # The last line may be incomplete if the process stopped while writing it
+                        continue
+
+        return plan
+
+    def remaining(self) -> list:
+        """ Gets the items that haven't been made yet in the order they were planned. """
+        return [x for x in self.items if get_key(x) not in self.done]
+
+    def mark_done(self, series: dict, status: str) -> None:
+        """ Records that an update was made, this is on disk before it returns. """
+        self.done.add(get_key(series))
+        tvdb_id, season, mal_id = get_key(series)
+        with open(self.journal_filepath, 'a') as f:
+            f.write(json.dumps({'tvdb_id': tvdb_id, 'season': season, 'mal_id': mal_id, 'status': status}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def discard(self) -> None:
+        """ Removes the plan and its journal once it has been finished. """
+        for filepath in (self.filepath, self.journal_filepath):
+            if os.path.exists(filepath):
+                os.remove(filepath)
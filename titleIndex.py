@@ -0,0 +1,304 @@
+import gzip
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+import xml.etree.ElementTree as et
+from array import array
+from collections import Counter
+from typing import Optional
+
+import config
+from config import TVDBID_ANIDBID_XML_FILEPATH
+from utils import log
+
+# How long to trust the index before checking the modification times of its sources again
+STAT_INTERVAL = 5
+# Titles sharing less than this proportion of their trigrams with the searched title aren't candidates
+MIN_SCORE = 0.3
+# Titles for a different season than the one searched for have their score multiplied by this
+SEASON_MISMATCH_PENALTY = 0.6
+# Trigrams in more than this proportion of the titles are skipped as long as the title has others to match on
+COMMON_TRIGRAM_RATIO = 0.05
+# The titles sharing the most trigrams with the searched title that are given an exact score
+CANDIDATES = 200
+MAL_URL_PATTERN = re.compile(r'myanimelist\.net/anime/(\d+)')
+ANIDB_URL_PATTERN = re.compile(r'anidb\.net/(?:anime/|a)(\d+)')
+ORDINAL_WORDS = {'first': 1, 'second': 2, 'third': 3, 'fourth': 4, 'fifth': 5, 'sixth': 6}
+ROMAN_NUMERALS = {'ii': 2, 'iii': 3, 'iv': 4, 'v': 5, 'vi': 6}
+SEASON_PATTERNS = (re.compile(r'\b(?:season|series|cour|part) (\d+)\b'),
+                   re.compile(r'\b(\d+)(?:st|nd|rd|th) (?:season|series)\b'),
+                   re.compile(r'\b(' + '|'.join(ORDINAL_WORDS) + r') season\b'),
+                   re.compile(r' (' + '|'.join(ROMAN_NUMERALS) + r')$'),
+                   re.compile(r' ([2-9])$'),
+                   re.compile(r'\bs([1-9])$'))
+
+
+def normalize_title(title: str) -> str:
+    """ Lowercases a title and removes accents and punctuation so different spellings compare equal. """
+    title = unicodedata.normalize('NFKD', title or '')
+    title = ''.join(x for x in title if not unicodedata.combining(x)).lower()
+    return ' '.join(re.sub(r'[^\w]+', ' ', title).split())
+
+
+def split_season(title: str) -> tuple:
+    """ Removes the season from a normalized title such as "show 2nd season" or "show ii".
+
+    :return: Tuple of the title without the season and the season number, which is 1 if none was found.
+    """
+    for pattern in SEASON_PATTERNS:
+        match = pattern.search(title)
+        if match is None:
+            continue
+
+        value = match.group(1)
+        season = ORDINAL_WORDS.get(value) or ROMAN_NUMERALS.get(value) or int(value)
+        base = ' '.join((title[:match.start()] + ' ' + title[match.end():]).split())
+        # Titles that are only a number such as "86" keep it as their title
+        if base != '' and season > 0:
+            return base, season
+
+    return title, 1
+
+
+def get_trigrams(title: str) -> set:
+    padded = f' {title} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TitleIndex:
+    def __init__(self, entries: list):
+        """ Trigram inverted index of anime titles for finding the anime an unmapped season is most likely to be.
+
+        Titles are stored once with their anime and season number in compact arrays, and every trigram maps to
+        an array of the titles that contain it, so a search only looks at the titles sharing a trigram with the
+        searched title.
+
+        :param entries: List of (anidb id, mal id, list of titles) tuples where either id may be None.
+                        Entries with the same anidb id are merged into one anime.
+        """
+        self.anidb_ids = []
+        self.mal_ids = []
+        self.titles = []
+        self.title_anime = array('I')
+        self.title_seasons = array('H')
+
+        postings = {}
+        anime_numbers = {}
+        seen = set()
+        for anidb_id, mal_id, titles in entries:
+            anime = anime_numbers.get(anidb_id) if anidb_id is not None else None
+            if anime is None:
+                anime = len(self.anidb_ids)
+                self.anidb_ids.append(anidb_id)
+                self.mal_ids.append(mal_id)
+                if anidb_id is not None:
+                    anime_numbers[anidb_id] = anime
+            elif self.mal_ids[anime] is None:
+                self.mal_ids[anime] = mal_id
+
+            for title in titles:
+                base, season = split_season(normalize_title(title))
+                if base == '' or (anime, base, season) in seen:
+                    continue
+
+                seen.add((anime, base, season))
+                title_number = len(self.titles)
+                self.titles.append(title)
+                self.title_anime.append(anime)
+                self.title_seasons.append(min(season, 0xFFFF))
+                for trigram in get_trigrams(base):
+                    postings.setdefault(trigram, []).append(title_number)
+
+        self.postings = {k: array('I', v) for k, v in postings.items()}
+        self.common_size = max(int(len(self.titles) * COMMON_TRIGRAM_RATIO), 100)
+
+    def __len__(self):
+        return len(self.titles)
+
+    def search(self, title: str, season: int = 1, limit: int = 5) -> list:
+        """ Finds the anime whose titles are most like a title.
+
+        The titles sharing the most trigrams with the searched title are found from the index and then scored
+        with the Dice coefficient of the trigrams of the titles without their seasons, reduced when the season
+        of the matched title isn't the one searched for.
+
+        :param title: The title to search for, this may include the season such as "Show Season 2".
+        :param season: The season number being searched for.
+        :param limit: The maximum number of anime to return.
+        :return: List of dictionaries with the anidb_id, mal_id, title and score of the best matching anime.
+        """
+        base, title_season = split_season(normalize_title(title))
+        season = int(season) if int(season) > 1 else title_season
+        query = get_trigrams(base)
+        trigrams = [x for x in query if x in self.postings]
+        if len(trigrams) == 0:
+            return []
+
+        # Very common trigrams add a lot of titles to count without telling them apart
+        rare = [x for x in trigrams if len(self.postings.get(x)) <= self.common_size]
+        counts = Counter()
+        for trigram in (rare if len(rare) * 2 >= len(trigrams) else trigrams):
+            counts.update(self.postings.get(trigram))
+
+        best = {}
+        for title_number, _ in counts.most_common(CANDIDATES):
+            title_trigrams = get_trigrams(split_season(normalize_title(self.titles[title_number]))[0])
+            score = 2 * len(query & title_trigrams) / (len(query) + len(title_trigrams))
+            if self.title_seasons[title_number] != season:
+                score *= SEASON_MISMATCH_PENALTY
+            if score < MIN_SCORE:
+                continue
+
+            anime = self.title_anime[title_number]
+            if score > best.get(anime, (0, None))[0]:
+                best[anime] = (score, title_number)
+
+        results = sorted(best.items(), key = lambda x: x[1][0], reverse = True)[:limit]
+        return [{'anidb_id': self.anidb_ids[anime],
+                 'mal_id'  : self.mal_ids[anime],
+                 'title'   : self.titles[title_number],
+                 'score'   : round(score, 3)} for anime, (score, title_number) in results]
+
+
+def read_anime_list_titles(filepath: str) -> list:
+    """ Reads the anime names of the anime-list XML.
+
+    :return: List of (anidb id, None, list of titles) tuples.
+    """
+    entries = []
+    root = None
+    for event, element in et.iterparse(filepath, events = ('start', 'end')):
+        if root is None:
+            root = element
+
+        if event != 'end' or element.tag != 'anime':
+            continue
+
+        anidb_id, name = element.get('anidbid') or '', element.findtext('name')
+        root.clear()
+        if anidb_id.isdigit() and name:
+            entries.append((anidb_id, None, [name]))
+
+    return entries
+
+
+def read_title_dump(filepath: str) -> list:
+    """ Reads an offline titles dump, either the anidb anime-titles.dat or the anime-offline-database json.
+
+    Both may be gzipped. The anidb dump has lines of aid|type|language|title and the json has a list of
+    anime in data with the title, synonyms and the urls of the anime on each site in sources.
+
+    :return: List of (anidb id, mal id, list of titles) tuples.
+    """
+    opener = gzip.open if filepath.endswith('.gz') else open
+    with opener(filepath, 'rt', encoding = 'utf-8') as f:
+        if '.json' in os.path.basename(filepath):
+            entries = []
+            for anime in json.load(f).get('data', []):
+                sources = ' '.join(anime.get('sources', []))
+                mal_match, anidb_match = MAL_URL_PATTERN.search(sources), ANIDB_URL_PATTERN.search(sources)
+                if mal_match is None and anidb_match is None:
+                    continue
+
+                entries.append((anidb_match.group(1) if anidb_match else None,
+                                mal_match.group(1) if mal_match else None,
+                                [anime.get('title')] + list(anime.get('synonyms', []))))
+            return entries
+
+        titles = {}
+        for line in f:
+            parts = line.rstrip('\n').split('|', 3)
+            if line.startswith('#') or len(parts) != 4 or not parts[0].isdigit():
+                continue
+            titles.setdefault(parts[0], []).append(parts[3])
+
+        return [(anidb_id, None, x) for anidb_id, x in titles.items()]
+
+
+class TitleMatcher:
+    def __init__(self):
+        """ Process-wide title index built from the anime-list XML names and the optional TITLE_DUMP_PATH.
+
+        The index is built the first time it is needed and only rebuilt when one of its sources changes,
+        either on a background thread with warm or by the first search to need it.
+        """
+        self._lock = threading.Lock()
+        self._index = None
+        self._mtimes = None
+        self._last_stat = 0
+
+    @staticmethod
+    def get_sources() -> list:
+        return [x for x in (TVDBID_ANIDBID_XML_FILEPATH, config.TITLE_DUMP_PATH) if x and os.path.exists(x)]
+
+    def _is_current(self) -> bool:
+        """ Checks whether the index has been built from the current version of its sources. """
+        now = time.time()
+        if self._index is not None and now - self._last_stat < STAT_INTERVAL:
+            return True
+
+        if self._index is None or [(x, os.path.getmtime(x)) for x in self.get_sources()] != self._mtimes:
+            return False
+
+        self._last_stat = now
+        return True
+
+    def get_index(self, block: bool = True) -> Optional[TitleIndex]:
+        """ Gets the index, building it first if it is missing or its sources have changed.
+
+        :param block: Whether to wait for the index to be built, otherwise it is built in the background and the
+                      previous index is returned.
+        :return: The index or None if it isn't blocking and there is no index yet.
+        """
+        if not block:
+            # The index is already being built
+            if not self._lock.acquire(blocking = False):
+                return self._index
+
+            try:
+                if not self._is_current():
+                    self.warm()
+                return self._index
+            finally:
+                self._lock.release()
+
+        with self._lock:
+            if self._is_current():
+                return self._index
+
+            start = time.perf_counter()
+            sources = self.get_sources()
+            mtimes = [(x, os.path.getmtime(x)) for x in sources]
+            entries = []
+            for filepath in sources:
+                try:
+                    if filepath == TVDBID_ANIDBID_XML_FILEPATH:
+                        entries.extend(read_anime_list_titles(filepath))
+                    else:
+                        entries.extend(read_title_dump(filepath))
+                except (OSError, ValueError, et.ParseError) as e:
+                    log(f"Unable to read anime titles from {filepath}: {e}")
+
+            self._index = TitleIndex(entries)
+            self._mtimes = mtimes
+            self._last_stat = time.time()
+            log(f"Indexed {len(self._index)} anime titles in {time.perf_counter() - start:.1f}s")
+            return self._index
+
+    def warm(self) -> None:
+        """ Builds the index on a background thread if it is missing or its sources have changed. """
+        threading.Thread(target = self.get_index, daemon = True).start()
+
+    def search(self, title: str, season: int = 1, limit: int = 5, block: bool = True) -> list:
+        """ Searches the index, see TitleIndex.search.
+
+        :param block: Whether to wait for the index to be built, otherwise nothing is found until there is one.
+        """
+        index = self.get_index(block)
+        return [] if index is None else index.search(title, season, limit)
+
+
+title_matcher = TitleMatcher()
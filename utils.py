@@ -1,22 +1,29 @@
 from datetime import datetime
 from typing import Union
 
-import schedule
 from colorama import Style
 import json
 import os
 import config
-from config import RECENT_UPDATES_PATH
+from logBuffer import log_buffer
+from dashboardState import dashboard_state
+from profiles import profiles, Profile
 import sys
+import threading
+
+# Profiles sync at the same time so changes to the recent updates of different profiles are made one at a time
+recent_updates_lock = threading.Lock()
 
 
 def log(text: str, *style: str) -> None:
-    """ Logs text with a specified style using colorama styles """
-    config.socketio.emit('new_log', {'log': text}, namespace = '/socket')
+    """ Logs text with a specified style using colorama styles.
+
+    The line is added to the log buffer which sends it to the web page and flushes stdout in batches.
+    """
+    log_buffer.append(text)
     config.latest_log = text
     timestamp = datetime.today().strftime('%d-%m-%Y %H:%M:%S')
     print(f"{timestamp} {''.join(style) + text}{Style.RESET_ALL}", file = sys.stdout)
-    sys.stdout.flush()
 
 
 def load_json(filepath: str, default_value: Union[list, dict] = None) -> Union[list, dict, None]:
@@ -47,24 +54,40 @@ def save_json(data: Union[list, dict], filepath: str) -> None:
     :param data: The data to write to the json file.
     :param filepath: The path where the json file will be saved.
     """
-    with open(filepath, 'w') as f:
+    # Write to a temporary file first so a crash mid-write never leaves a truncated file behind
+    temp_filepath = f'{filepath}.tmp'
+    with open(temp_filepath, 'w') as f:
         json.dump(data, f)
 
+    os.replace(temp_filepath, filepath)
+
+
+def load_recent_updates() -> dict:
+    """ Gets the recent updates of every profile, loading them into the dashboard state the first time.
+
+    :return: Dictionary of profile names to their list of recent updates. This must not be modified.
+    """
+    with recent_updates_lock:
+        if not dashboard_state.is_loaded('recent_updates'):
+            dashboard_state.update(recent_updates = {x.name: load_json(x.recent_updates_path, []) for x in profiles})
+
+        return dashboard_state.recent_updates
+
 
-def get_countdown():
-    next_run = schedule.jobs[0].next_run
-    seconds = (next_run - datetime.now()).total_seconds()
-    m, s = divmod(seconds, 60)
-    h, m = divmod(m, 60)
-    if h < 0:
-        h, m, s = 0, 0, 0
+def get_recent_updates(profile: Profile) -> list:
+    return list(load_recent_updates().get(profile.name, []))
 
-    return f'{int(h):02} : {int(m):02} : {int(s):02}'
 
+def save_recent_updates(profile: Profile, recent_updates: list):
+    load_recent_updates()
+    with recent_updates_lock:
+        save_json(recent_updates[-10:], profile.recent_updates_path)
+        dashboard_state.update(recent_updates = {**dashboard_state.recent_updates, profile.name: recent_updates[-10:]})
 
-def get_recent_updates():
-    return load_json(RECENT_UPDATES_PATH, [])
 
+def format_recent_updates(recent_updates: dict) -> str:
+    """ Formats the recent updates for the dashboard, under the name of each profile when there is more than one. """
+    if len(recent_updates) <= 1:
+        return "\n".join(line for lines in recent_updates.values() for line in lines)
 
-def save_recent_updates(recent_updates: list):
-    save_json(recent_updates[-10:], RECENT_UPDATES_PATH)
+    return "\n\n".join(f"{name}\n" + "\n".join(lines) for name, lines in recent_updates.items())